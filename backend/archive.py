@@ -0,0 +1,128 @@
+"""
+Archive module
+
+Games are reused: each new game with the same tag expires the previous game's
+actions and chat messages. Expired rows are moved out of the live `actions`
+and `messages` tables into the append-only `actions_archive` and
+`messages_archive` tables, so that the live tables only hold the working set
+of each game.
+
+Rows are moved in bulk with an INSERT ... SELECT followed by a DELETE, in the
+caller's transaction. WurwolvesGame.clear_actions and
+WurwolvesGame.clear_chat_messages archive their game's rows as they expire
+them. Rows expired before this existed, and actions left without a game by
+older versions of end_game, can be archived by running this module:
+
+    python -m backend.archive
+"""
+
+import logging
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+
+from .model import Action
+from .model import ArchivedAction
+from .model import ArchivedMessage
+from .model import Message
+
+logger = logging.getLogger("archive")
+
+
+_ACTION_COLUMNS = [
+    "id",
+    "time_created",
+    "game_id",
+    "player_id",
+    "stage_id",
+    "selected_player_id",
+    "stage",
+    "role",
+    "random_field",
+]
+
+_MESSAGE_COLUMNS = [
+    "id",
+    "time_created",
+    "game_id",
+    "text",
+    "is_strong",
+    "recipients",
+]
+
+
+def _move_expired(connection, live, archive, columns, game_id: Optional[int]) -> int:
+    live_table = live.__table__
+    archive_table = archive.__table__
+
+    if game_id is not None:
+        is_expired = (live_table.c.expired == True) & (live_table.c.game_id == game_id)
+    else:
+        # Rows detached from their game are archived too
+        is_expired = (live_table.c.expired == True) | live_table.c.game_id.is_(None)
+
+    connection.execute(
+        insert(archive_table).from_select(
+            [archive_table.c[c] for c in columns],
+            select(*[live_table.c[c] for c in columns]).where(is_expired),
+        )
+    )
+
+    return connection.execute(live_table.delete().where(is_expired)).rowcount
+
+
+def archive_expired_actions(connection, game_id: Optional[int] = None) -> int:
+    """
+    Move expired actions into the archive, for one game or all of them
+
+    When archiving all games, actions which were removed from their game but
+    never deleted (so have no game_id) are archived too.
+
+    Returns the number of actions moved.
+    """
+    return _move_expired(connection, Action, ArchivedAction, _ACTION_COLUMNS, game_id)
+
+
+def archive_expired_messages(connection, game_id: Optional[int] = None) -> int:
+    """
+    Move expired messages into the archive, for one game or all of them
+
+    Returns the number of messages moved.
+    """
+    return _move_expired(
+        connection, Message, ArchivedMessage, _MESSAGE_COLUMNS, game_id
+    )
+
+
+def get_archived_chat_cursor(connection, game_id: int) -> int:
+    """
+    Get the ID of the newest archived message in this game, or 0 if none
+    """
+    return (
+        connection.execute(
+            select(func.max(ArchivedMessage.id)).where(
+                ArchivedMessage.game_id == game_id
+            )
+        ).scalar()
+        or 0
+    )
+
+
+def archive_all() -> None:
+    """
+    Archive the expired actions and messages of every game
+    """
+    from . import database
+
+    with database.engine.begin() as connection:
+        num_actions = archive_expired_actions(connection)
+        num_messages = archive_expired_messages(connection)
+
+    logger.info("Archived %s actions and %s messages", num_actions, num_messages)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    archive_all()
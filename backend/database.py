@@ -1,6 +1,10 @@
+import asyncio
+import contextvars
+import functools
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from dotenv import find_dotenv
@@ -8,7 +12,9 @@ from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 load_dotenv(find_dotenv())
 
@@ -16,6 +22,27 @@ load_dotenv(find_dotenv())
 engine = None
 Session = None
 
+# Number of threads available for database work from async code
+DB_THREADS = int(os.environ.get("DB_THREADS", 8))
+
+# Connection pool settings. See the SQLAlchemy docs for create_engine.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+# Recycle connections after this many seconds. -1 to never recycle
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", -1))
+# Test connections before using them: costs a round trip per checkout
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Time in milliseconds for SQLite to wait for a lock before failing
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+
+_executor = None
+
 
 logger = logging.getLogger("sqltimings")
 if os.environ.get("DEBUG_DATABASE"):
@@ -52,9 +79,70 @@ def load():
     global engine
     global Session
 
-    engine = create_engine(db_url)
+    engine = create_engine(db_url, **engine_kwargs(db_url))
     Session = sessionmaker(bind=engine)
 
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _configure_sqlite_connection)
+
+
+def engine_kwargs(db_url: str) -> dict:
+    """
+    Get the arguments for create_engine, including the pool settings
+    """
+    url = make_url(db_url)
+
+    if url.get_backend_name() == "sqlite":
+        if not url.database or url.database == ":memory:":
+            # In-memory databases only exist in a single connection
+            return {"connect_args": {"check_same_thread": False}}
+
+        # Sessions may be used from several threads (see run_in_db_thread),
+        # though never at once. SQLite would otherwise use a NullPool for
+        # files, opening a new connection for every session.
+        return {
+            "connect_args": {"check_same_thread": False},
+            "poolclass": QueuePool,
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+        }
+
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets readers (e.g. long polls) continue while a game is being written
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+def pool_stats() -> dict:
+    """
+    Get the state of the connection pool
+
+    Returns an empty dict if the pool doesn't track these statistics
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+
 
 @contextmanager
 def session_scope():
@@ -70,4 +158,30 @@ def session_scope():
         session.close()
 
 
+def get_executor() -> ThreadPoolExecutor:
+    """Get the threadpool reserved for database work, making it if required"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=DB_THREADS, thread_name_prefix="wurwolves-db"
+        )
+    return _executor
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """
+    Run a blocking database function without blocking the event loop
+
+    The function runs in a dedicated threadpool so that database work can't
+    starve other users of the default executor. Context variables (e.g. the
+    request's instrumentation) are copied into the thread.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(),
+        functools.partial(context.run, func, *args, **kwargs),
+    )
+
+
 load()
@@ -15,21 +15,25 @@ from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Union
 from uuid import UUID
 
 import pydantic
 from fastapi import HTTPException
-from sqlalchemy import bindparam
-from sqlalchemy import or_
-from sqlalchemy.ext import baked
 
+from . import archive
+from . import instrumentation
+from . import notifications
+from . import presence
+from . import queries
 from . import resolver
 from . import roles
 from .model import Action
-from .model import ActionModel
+from .model import ChatUpdate
 from .model import DistributionSettings
 from .model import FrontendState
+from .model import FrontendStateDelta
 from .model import Game
 from .model import GameModel
 from .model import GameStage
@@ -39,10 +43,13 @@ from .model import Player
 from .model import PlayerModel
 from .model import PlayerRole
 from .model import PlayerState
+from .model import SlimActionModel
 from .model import User
 from .model import UserModel
 from .roles import get_action_func_name
 from .roles import get_apparant_role
+from .utils import LRUCache
+from .utils import make_json_patch
 
 
 SPECTATOR_TIMEOUT = datetime.timedelta(seconds=40)
@@ -53,16 +60,31 @@ GET_HASH_TIMEOUT = 20
 
 MAX_NAME_LENGTH = 25
 
+# Maximum number of games to hold in the snapshot cache, and the time in
+# seconds after which a cached snapshot is reloaded even if it seems current
+SNAPSHOT_CACHE_SIZE = 256
+SNAPSHOT_CACHE_TTL = 60
+
+# Maximum number of viewers whose last rendered state is kept for computing
+# deltas, and the time in seconds for which it's kept
+RENDERED_STATE_CACHE_SIZE = 4096
+RENDERED_STATE_CACHE_TTL = 300
+
 NAMES_FILE = os.path.join(os.path.dirname(__file__), "names.txt")
 names = None
 
-update_events: Dict[int, asyncio.Event] = {}
-
 logger = logging.getLogger("game")
 
-# A bakery for SQLAlchemy queries
-bakery = baked.bakery()
+# Cache of game_id -> GameSnapshot. Entries are only used if their update_tag
+# matches the database, so they can't go stale even if another worker alters
+# the game.
+snapshot_cache = LRUCache(max_size=SNAPSHOT_CACHE_SIZE, ttl=SNAPSHOT_CACHE_TTL)
 
+# Cache of (game_id, user_id) -> the last FrontendState sent to that viewer, as
+# JSON-compatible data. Used as the base for FrontendStateDeltas.
+rendered_state_cache = LRUCache(
+    max_size=RENDERED_STATE_CACHE_SIZE, ttl=RENDERED_STATE_CACHE_TTL
+)
 
 # Presets for role generation
 LOOKUP_CONFIG = {
@@ -88,6 +110,49 @@ class ChatMessage(pydantic.BaseModel):
     is_strong: bool = False
 
 
+class SnapshotMessage(pydantic.BaseModel):
+    id: int
+    text: str
+    is_strong: bool
+
+    # IDs of the players who can see this message. Empty if visible to all.
+    visible_to: Set[int]
+
+
+class PlayerActionState(pydantic.BaseModel):
+    has_action: bool
+    action_enabled: bool
+
+
+class GameSnapshot(pydantic.BaseModel):
+    """
+    The parts of a game loaded from the database that are needed to render it
+
+    This is independent of who is viewing the game, so can be shared between
+    all the players' requests until the game's update_tag changes. Use
+    render_state to project it into the FrontendState seen by a single user.
+    """
+
+    game: GameModel
+
+    # Players who should be displayed in this stage of the game
+    players: List[PlayerModel]
+
+    # Action availability of every player in the game, keyed by player ID
+    actions: Dict[int, PlayerActionState]
+
+    # Unexpired messages in the chat log, in order
+    messages: List[SnapshotMessage]
+
+    # ID of the newest message in the game, expired or not, or 0 if none
+    chat_cursor: int
+
+    is_customized: bool
+
+    # Number of nights that have passed before this stage
+    num_previous_nights: int
+
+
 class WurwolvesGame:
     """
     Provides methods for accessing all the properties of a wurwolves game. This
@@ -129,8 +194,12 @@ class WurwolvesGame:
 
         Close the session once all @db_scoped methods are finished (if the session is not external)
 
-        If any of the decorated functions altered the database state, also release an asyncio
-        event marking this game as having been updated
+        These methods block while they access the database, so async code
+        should call them through database.run_in_db_thread. A warning is logged
+        if one is called on a thread which is running an event loop.
+
+        If any of the decorated functions altered the database state, also notify
+        any subscribers (in this or other workers) that this game has been updated
         """
         from . import database
 
@@ -141,6 +210,8 @@ class WurwolvesGame:
                 self._session = database.Session()
             if self._session_users == 0:
                 self._session_modified = False
+                self._session_started = time.perf_counter()
+                _warn_if_on_event_loop(func)
 
             try:
                 self._session_users += 1
@@ -156,10 +227,9 @@ class WurwolvesGame:
                 raise e
             finally:
                 if self._session_users == 1 and self._session_modified:
-                    # If any of the functions altered the game state, fire
-                    # the corresponding updates events if they are present
-                    # in the global dict And mark the game as altered in the
-                    # database.
+                    # If any of the functions altered the game state, mark
+                    # the game as altered in the database. Subscribers are
+                    # notified once the session is committed.
                     #
                     # Check this before we reduce session_users to 0, else
                     # calling get_game will reopen a new session before the
@@ -174,6 +244,10 @@ class WurwolvesGame:
                     logger.debug("Committing session")
                     self._session.commit()
 
+                    instrumentation.record_session(
+                        time.perf_counter() - self._session_started
+                    )
+
                     if self._session_modified:
                         logger.debug("...and triggering updates")
                         trigger_update_event(self.game_id)
@@ -249,13 +323,16 @@ class WurwolvesGame:
         return user
 
     @db_scoped
-    def get_game(self) -> Game:
-        baked_query = bakery(lambda session: session.query(Game))
-        baked_query += lambda q: q.filter(Game.id == bindparam("game_id"))
-
-        result = baked_query(self._session).params(game_id=self.game_id).first()
+    def get_game(self, profile: Optional[str] = None) -> Game:
+        """
+        Get the Game database model
 
-        return result
+        If a profile from queries.GAME_LOADER_PROFILES is given, load the
+        relationships that it lists with the game. Otherwise they're loaded
+        lazily when accessed. Relationships which are already loaded in this
+        session aren't reloaded.
+        """
+        return queries.get_game(self._session, self.game_id, profile)
 
     @db_scoped
     def get_game_model(self) -> GameModel:
@@ -264,13 +341,12 @@ class WurwolvesGame:
 
     @db_scoped
     def get_player_id(self, user_id: UUID) -> int:
-        game = self.get_game()
+        player_id = queries.get_player_id(self._session, self.game_id, user_id)
 
-        for p in game.players:
-            if p.user_id == user_id:
-                return p.id
+        if player_id is None:
+            raise KeyError(f"User {user_id} not found in this game")
 
-        raise KeyError(f"User {user_id} not found in this game")
+        return player_id
 
     @db_scoped
     def get_player(self, user_id: UUID, filter_by_activity=True) -> Player:
@@ -279,14 +355,9 @@ class WurwolvesGame:
         `filter_by_activity`, only return players who should be displayed in this
         stage of the game.
         """
-        players = self.get_players(filter_by_activity=filter_by_activity)
-
-        this_player = [p for p in players if p.user_id == user_id]
-
-        if this_player:
-            return this_player[0]
-        else:
-            return None
+        return queries.get_player(
+            self._session, self.game_id, user_id, active_only=filter_by_activity
+        )
 
     @db_scoped
     def get_player_by_id(self, player_id: int, filter_by_activity=False) -> Player:
@@ -296,7 +367,7 @@ class WurwolvesGame:
         stage of the game.
         """
 
-        p = self._session.query(Player).get(player_id)
+        p = queries.get_player_by_id(self._session, player_id)
 
         if filter_by_activity and not _player_is_active(p):
             return None
@@ -323,17 +394,18 @@ class WurwolvesGame:
         If `filter_by_activity`, only return Players who should be displayed in
         this stage of the game.
         """
-        game = self.get_game()
-        if not game:
-            raise HTTPException(404, "Game not found")
-
-        players = game.players
+        q = self._session.query(Player).filter(Player.game_id == self.game_id)
 
         if filter_by_activity:
-            players = [p for p in players if _player_is_active(p)]
+            q = _filter_by_activity(q)
 
         if role:
-            players = [p for p in players if p.role == role]
+            q = q.filter(Player.role == role)
+
+        players = q.order_by(Player.id).all()
+
+        if not players and not self.get_game():
+            raise HTTPException(404, "Game not found")
 
         return players
 
@@ -353,33 +425,36 @@ class WurwolvesGame:
 
         Filter by the passed parameters if any.
         """
-        actions = self.get_game().actions
+        if stage_id and not (player_id or stage or include_expired):
+            return queries.get_stage_actions(self._session, self.game_id, stage_id)
+
+        q = self._session.query(Action).filter(Action.game_id == self.game_id)
 
         if stage_id:
-            actions = [a for a in actions if a.stage_id == stage_id]
+            q = q.filter(Action.stage_id == stage_id)
 
         if player_id:
-            actions = [a for a in actions if a.player_id == player_id]
+            q = q.filter(Action.player_id == player_id)
 
         if stage:
-            actions = [a for a in actions if a.stage == stage]
+            q = q.filter(Action.stage == stage)
 
         if not include_expired:
-            actions = [a for a in actions if a.expired == False]
+            q = q.filter(Action.expired == False)
 
-        return actions
+        return q.order_by(Action.id).all()
 
     @db_scoped
     def get_actions_model(
         self, stage_id=None, player_id: int = None, stage: GameStage = None
-    ) -> List[ActionModel]:
+    ) -> List[SlimActionModel]:
         """Get models for Actions in this game.
 
-        Filter by the passed parameters if any.
-
-        Default to the current stage."""
+        Filter by the passed parameters if any. The models don't include the
+        related game and players: look these up by ID if required.
+        """
         return [
-            ActionModel.from_orm(a)
+            SlimActionModel.from_orm(a)
             for a in self.get_actions(stage_id, player_id, stage)
         ]
 
@@ -410,14 +485,14 @@ class WurwolvesGame:
     @db_scoped
     def send_team_message(self, user_id: UUID, message: str):
         role = self.get_player(user_id).role
-        team = roles.get_role_team(role)
+        team_roles = roles.get_team_roles(roles.get_role_team(role))
         role_description = roles.get_role_description(role)
 
         if not role_description.secret_chat_enabled:
             raise HTTPException(f"Role {role} does not have secret chat")
         if role_description.secret_chat_enabled is role_description.SecretChatType.TEAM:
             players_to_receive = [
-                p.id for p in self.get_players() if roles.get_role_team(p.role) == team
+                p.id for p in self.get_players() if p.role in team_roles
             ]
         elif (
             role_description.secret_chat_enabled is role_description.SecretChatType.ROLE
@@ -428,15 +503,48 @@ class WurwolvesGame:
 
     @db_scoped
     def get_hash_now(self):
-        baked_query = bakery(lambda session: session.query(Game.update_tag))
-        baked_query += lambda q: q.filter(Game.id == bindparam("game_id"))
-
-        update_tag = baked_query(self._session).params(game_id=self.game_id).first()
+        update_tag = queries.get_hash(self._session, self.game_id)
 
-        ret = update_tag[0] if update_tag else 0
+        ret = update_tag if update_tag is not None else 0
         logger.info(f"Current hash {ret}, game {self.game_id}")
         return ret
 
+    def read_hash(self) -> int:
+        """
+        Get the latest hash of this game, outside of any session
+
+        The hash comes from the notifier's cache if it can be trusted, else
+        from a single SELECT on a pooled connection. Nothing is committed and
+        no ORM objects are loaded. Use get_hash_now instead within a
+        @db_scoped method, which might have changed the game.
+        """
+        from . import database
+
+        notifier = notifications.get_notifier()
+
+        update_tag = notifier.get_cached_hash(self.game_id)
+        if update_tag is not None:
+            return update_tag
+
+        token = notifier.hash_token()
+
+        with database.engine.connect() as connection:
+            update_tag = queries.get_hash(connection, self.game_id) or 0
+
+        notifier.cache_hash(self.game_id, update_tag, token)
+
+        return update_tag
+
+    async def _read_hash_async(self) -> int:
+        from .database import run_in_db_thread
+
+        # Don't bother with a thread if the hash is cached
+        update_tag = notifications.get_notifier().get_cached_hash(self.game_id)
+        if update_tag is not None:
+            return update_tag
+
+        return await run_in_db_thread(self.read_hash)
+
     async def get_hash(self, known_hash=None, timeout=GET_HASH_TIMEOUT) -> int:
         """
         Gets the latest hash of this game
@@ -444,37 +552,52 @@ class WurwolvesGame:
         If known_hash is provided and is the same as the current hash,
         do not return immediately: wait for up to timeout seconds.
 
-        Note that this function is not @db_scoped, but it calls one that is:
-        this is to prevent the database being locked while it waits
+        Note that this function is not @db_scoped and doesn't open a session:
+        this is to prevent the database being locked while it waits. See
+        read_hash.
         """
-        current_hash = self.get_hash_now()
+        if known_hash is None:
+            return await self._read_hash_async()
 
-        # Return immediately if the hash has changed or if there's no known hash
-        if known_hash is None or known_hash != current_hash:
-            return current_hash
+        # Subscribe to changes to this game before reading its hash, so that
+        # changes committed while it's being read aren't missed
+        with notifications.get_notifier().subscribe(self.game_id) as changed:
+            current_hash = await self._read_hash_async()
 
-        # Otherwise, lookup / make an event and subscribe to it
-        if self.game_id not in update_events:
-            update_events[self.game_id] = asyncio.Event()
-            logger.info("Made new event for game %s", self.game_id)
-        else:
-            logger.info("Subscribing to event for %s", self.game_id)
+            # Return immediately if the hash has changed
+            if known_hash != current_hash:
+                return current_hash
 
-        try:
-            event = update_events[self.game_id]
-            await asyncio.wait_for(event.wait(), timeout=timeout)
-            logger.info(f"Event received for game {self.game_id}")
-            return self.get_hash_now()
-        except asyncio.TimeoutError:
-            return current_hash
+            # Otherwise, wait for a change
+            logger.info("Waiting for updates to %s", self.game_id)
+
+            if await notifications.wait_for_event(changed, timeout):
+                logger.info(f"Event received for game {self.game_id}")
+                return await self._read_hash_async()
+            else:
+                return current_hash
 
     @db_scoped
     def touch(self):
         self._session_modified = True
         self.get_game().touch()
 
-    @db_scoped
     def player_keepalive(self, user_id: UUID):
+        """
+        Record that this user is still connected
+
+        Usually this only records a heartbeat in the presence store, which is
+        written to the database in batches and swept for inactive players by
+        presence.run_sweeper. If this player hasn't been checked recently
+        they're looked up and touched in the database instead.
+        """
+        if presence.store.heartbeat(self.game_id, user_id):
+            return
+
+        self._player_keepalive_in_db(user_id)
+
+    @db_scoped
+    def _player_keepalive_in_db(self, user_id: UUID):
         p = self.get_player(user_id, filter_by_activity=False)
         if not p:
             raise HTTPException(
@@ -490,32 +613,66 @@ class WurwolvesGame:
         p.touch()
         self._session.flush()
 
-        players = self.get_players(filter_by_activity=False)
-        game = self.get_game()
+        presence.store.remember(self.game_id, user_id, p.id, p.last_seen)
+
+        self.update_activity()
+
+    @db_scoped
+    def update_activity(self):
+        """
+        Mark any players who haven't been seen in a while as inactive and
+        any who have as active
+
+        This will only have an effect if the game is in particular states. The
+        game is only altered if someone's activity changes.
+        """
+        game = self.get_game("keepalive")
+        if not game:
+            return
+
+        threshold = presence.stale_threshold()
 
-        threshold = datetime.datetime.utcnow() - SPECTATOR_TIMEOUT
+        # This worker may have heard from players since their last_seen was written
+        heartbeats = presence.store.get_heartbeats(self.game_id)
 
-        # Mark any players who haven't been seen in a while as inactive. This
-        # will only have an effect if the game is in particular states
         someone_changed = False
 
-        for p in players:
-            if p.active and p.last_seen <= threshold:
+        for p in game.players:
+            last_seen = p.last_seen
+            heartbeat = heartbeats.get(p.id)
+            if heartbeat and (last_seen is None or heartbeat > last_seen):
+                last_seen = heartbeat
+
+            if p.active and last_seen <= threshold:
                 logger.info(
-                    f"Marking player {p.user.name} as inactive (p.last_seen="
-                    f"{p.last_seen}, threshold={threshold})"
+                    f"Marking player {p.user.name} as inactive (last_seen="
+                    f"{last_seen}, threshold={threshold})"
                 )
                 p.active = False
                 someone_changed = True
-            elif not p.active and p.last_seen > threshold:
+
+                # Check they still exist when they next poll
+                presence.store.forget_player(self.game_id, p.id)
+            elif not p.active and last_seen > threshold:
                 logger.info(f"Marking player {p.user.name} as active")
                 p.active = True
                 someone_changed = True
 
         if someone_changed:
-            self.touch()
-            # Reevaluate processed actions
-            self.process_actions(game.stage, game.stage_id)
+            self.activity_changed()
+
+    @db_scoped
+    def activity_changed(self):
+        """
+        Update the game after players have been marked as active or inactive
+        """
+        game = self.get_game()
+        if not game:
+            return
+
+        self.touch()
+        # Reevaluate processed actions
+        self.process_actions(game.stage, game.stage_id)
 
     @db_scoped
     def create_game(self):
@@ -535,24 +692,21 @@ class WurwolvesGame:
 
     @db_scoped
     def end_game(self):
-        game = self.get_game()
-
         # Give all the players another SPECTATOR_TIMEOUT before they are kicked for inactivity,
         # so people have time to see what happened
         for p in self.get_players():
             p.touch()
 
-        # Delete all remaining actions
-        del game.actions[:]
+        # Archive all remaining actions
+        self.clear_actions()
 
         # End the game
         self._set_stage(GameStage.ENDED)
 
     @db_scoped
     def move_to_lobby(self):
-        # Delete all remaining actions
-        game = self.get_game()
-        del game.actions[:]
+        # Archive all remaining actions
+        self.clear_actions()
 
         self._wipe_all_roles()
 
@@ -707,30 +861,64 @@ class WurwolvesGame:
     @db_scoped
     def get_messages(self, user_id: UUID, include_expired=False) -> List[ChatMessage]:
         """Get chat messages visible to the given user"""
-        messages = self.get_game().messages
+        q = self._session.query(Message).filter(Message.game_id == self.game_id)
+
+        if not include_expired:
+            q = q.filter(Message.expired == False)
+
         player = self.get_player(user_id)
+        player_id = player.id if player else None
 
+        # Recipients are stored as JSON, so are filtered here
         visible_messages = [
-            m for m in messages if not m.visible_to or player in m.visible_to
+            m
+            for m in q.order_by(Message.id)
+            if m.recipients is None or player_id in m.recipients
         ]
 
-        if not include_expired:
-            visible_messages = [m for m in visible_messages if not m.expired]
-
         # Format as ChatMessages
         return [
             ChatMessage(text=m.text, is_strong=m.is_strong) for m in visible_messages
         ]
 
+    def _forget_archived_rows(self):
+        """
+        Expire everything loaded in this session, since rows which might be
+        in its collections have been moved to the archive. Pending changes
+        are flushed first so that they aren't lost.
+        """
+        self._session.flush()
+        self._session.expire_all()
+
     @db_scoped
     def clear_chat_messages(self):
-        for m in self.get_game().messages:
-            m.expired = True
+        num_expired = (
+            self._session.query(Message)
+            .filter(Message.game_id == self.game_id, Message.expired == False)
+            .update({Message.expired: True}, synchronize_session=False)
+        )
+
+        archive.archive_expired_messages(self._session.connection(), self.game_id)
+        self._forget_archived_rows()
+
+        # Bulk updates don't dirty the session, so flag the change directly
+        if num_expired:
+            self._session_modified = True
 
     @db_scoped
     def clear_actions(self):
-        for a in self.get_game().actions:
-            a.expired = True
+        num_expired = (
+            self._session.query(Action)
+            .filter(Action.game_id == self.game_id, Action.expired == False)
+            .update({Action.expired: True}, synchronize_session=False)
+        )
+
+        archive.archive_expired_actions(self._session.connection(), self.game_id)
+        self._forget_archived_rows()
+
+        # Bulk updates don't dirty the session, so flag the change directly
+        if num_expired:
+            self._session_modified = True
 
     @db_scoped
     def send_chat_message(self, msg, is_strong=False, user_list=[], player_list=[]):
@@ -745,23 +933,16 @@ class WurwolvesGame:
             player_list (List[int], optional): List of player IDs who can see the
                                         message. All players if None. Merged with user_list
         """
+        recipients = [self.get_player(user_id).id for user_id in user_list]
+        recipients.extend(player_list)
+
         m = Message(
             text=msg,
             is_strong=is_strong,
             game_id=self.game_id,
+            recipients=sorted(set(recipients)) if recipients else None,
         )
 
-        players = []
-
-        for user_id in user_list:
-            players.append(self.get_player(user_id))
-
-        for player_id in player_list:
-            players.append(self.get_player_by_id(player_id))
-
-        for player in players:
-            m.visible_to.append(player)
-
         g = self.get_game()
         g.messages.append(m)
 
@@ -822,6 +1003,7 @@ class WurwolvesGame:
         state as required.
         """
         players = self.get_players()
+        context = self.get_availability_context()
 
         ready = True
         for player in players:
@@ -838,7 +1020,9 @@ class WurwolvesGame:
             ):
                 continue
 
-            has_action, action_enabled = self.player_has_action(player, stage, stage_id)
+            has_action, action_enabled = self.player_has_action(
+                player, stage, stage_id, context
+            )
             if has_action and action_enabled:
                 logger.info("Stage not complete: %s has not acted", player.user.name)
                 ready = False
@@ -861,8 +1045,7 @@ class WurwolvesGame:
 
     @db_scoped
     def get_user(self, user_id: UUID):
-        u = self._session.query(User).get(user_id)
-        return u
+        return queries.get_user(self._session, user_id)
 
     @db_scoped
     def get_user_name(self, user_id: UUID):
@@ -888,7 +1071,7 @@ class WurwolvesGame:
         from . import database
 
         with database.session_scope() as s:
-            u: User = s.query(User).get(user_id)
+            u: User = queries.get_user(s, user_id)
 
             if not u:
                 u = cls.make_user(s, user_id)
@@ -936,9 +1119,28 @@ class WurwolvesGame:
 
         return bool(players)
 
+    @db_scoped
+    def get_availability_context(
+        self, game: Optional[Game] = None
+    ) -> resolver.ActionAvailabilityContext:
+        """
+        Gather the facts needed to decide which actions are available in this game
+
+        Pass this to player_has_action when checking several players so that
+        the game's players and actions are only examined once. Pass `game` if
+        it's already been loaded with its players and actions.
+        """
+        if game is None:
+            game = self.get_game("resolve")
+        return resolver.ActionAvailabilityContext(game.players, game.actions)
+
     @db_scoped
     def player_has_action(
-        self, player: Union[int, Player], stage: GameStage, stage_id: int
+        self,
+        player: Union[int, Player, PlayerModel],
+        stage: GameStage,
+        stage_id: int,
+        context: Optional[resolver.ActionAvailabilityContext] = None,
     ):
         """Does this player have an action this turn? And have they already performed it?"""
 
@@ -958,10 +1160,13 @@ class WurwolvesGame:
             f"player.state = {player.state}, action_class.allowed_player_states = {action_class.allowed_player_states}"
         )
 
+        if context is None:
+            context = self.get_availability_context()
+
         # Player has an action in this stage...
         has_action = (
             player.state in action_class.allowed_player_states
-            and action_class.is_action_available(self, stage, stage_id, player.id)
+            and action_class.is_action_available(context, stage, stage_id, player.id)
         )
 
         if not has_action:
@@ -969,27 +1174,20 @@ class WurwolvesGame:
         # ...that doesn't require them to be active or it does, and they are
         elif action_class.active_players_only and not player.active:
             action_enabled = False
-        #  ..and they hasn't yet acted
+        #  ..and they hasn't yet acted
         elif (
             action_class.round_end_behaviour
             == resolver.RoundEndBehaviour.MULTIPLE_OPTIONAL
         ):
             action_enabled = True
         elif action_class.team_action == resolver.TeamBehaviour.ONCE_PER_TEAM:
-            # Which roles are on my team?
-            my_team = roles.get_role_team(player.role)
-            my_team_roles = [
-                role
-                for role in list(PlayerRole)
-                if roles.get_role_team(role) == my_team
-            ]
-
-            actions = [a for a in self.get_game().actions if a.stage_id == stage_id]
-            actions_by_my_team = [a for a in actions if a.role in my_team_roles]
-
-            action_enabled = not bool(actions_by_my_team)
+            # Has anyone on my team acted?
+            my_team_roles = roles.get_team_roles(roles.get_role_team(player.role))
+            action_enabled = my_team_roles.isdisjoint(context.roles_acted(stage_id))
         else:
-            action_enabled = not any(a.stage_id == stage_id for a in player.actions)
+            action_enabled = not context.player_has_acted(
+                player.id, stage_id=stage_id, include_expired=True
+            )
 
         return has_action, action_enabled
 
@@ -1005,190 +1203,364 @@ class WurwolvesGame:
         return name
 
     @db_scoped
-    def parse_game_to_state(self, user_id: UUID) -> FrontendState:
+    def get_snapshot(self) -> Optional[GameSnapshot]:
+        """
+        Get a GameSnapshot of this game, or None if it doesn't exist
+
+        Use the cached snapshot if its update_tag is current, so that a burst
+        of requests after a change only loads the game once.
+        """
+        update_tag = self.get_hash_now()
+
+        snapshot = snapshot_cache.get(self.game_id)
+        if snapshot and snapshot.game.update_tag == update_tag:
+            logger.debug("Using cached snapshot for game %s", self.game_id)
+            return snapshot
+
+        snapshot = self._load_snapshot()
+        if snapshot:
+            snapshot_cache.put(self.game_id, snapshot)
+
+        return snapshot
+
+    @db_scoped
+    def _load_snapshot(self, filter_by_activity=True) -> Optional[GameSnapshot]:
+        game = self.get_game("render")
+        if not game:
+            return None
+
+        game_model = GameModel.from_orm(game)
+
+        players = game_model.players
+        if filter_by_activity:
+            players = [p for p in players if _player_is_active(p)]
+
+        context = self.get_availability_context(game)
+
+        actions = {}
+        for p in game_model.players:
+            has_action, action_enabled = self.player_has_action(
+                p, game.stage, game.stage_id, context
+            )
+            actions[p.id] = PlayerActionState(
+                has_action=has_action, action_enabled=action_enabled
+            )
+
+        return GameSnapshot(
+            game=game_model,
+            players=players,
+            actions=actions,
+            messages=[
+                SnapshotMessage(
+                    id=m.id,
+                    text=m.text,
+                    is_strong=m.is_strong,
+                    visible_to=set(m.recipients or ()),
+                )
+                for m in game_model.messages
+                if not m.expired
+            ],
+            chat_cursor=(
+                game_model.messages[-1].id
+                if game_model.messages
+                else archive.get_archived_chat_cursor(
+                    self._session.connection(), self.game_id
+                )
+            ),
+            is_customized=game.distribution_settings is not None,
+            num_previous_nights=self.num_previous_stages(
+                GameStage.NIGHT, game.stage_id
+            ),
+        )
+
+    @db_scoped
+    def parse_game_to_state(
+        self, user_id: UUID, chat_since: Optional[int] = None
+    ) -> FrontendState:
         """
         Parse this game into a FrontendState for viewing by the user user_id
+
+        If chat_since is given, only include chat messages newer than the
+        message with this ID
         """
 
         if logger.isEnabledFor(logging.DEBUG):
             t_start = time.time()
             logger.debug(f"Starting parse_game_to_state")
 
-        game = self.get_game()
+        snapshot = self.get_snapshot()
 
-        logger.debug("Game is loaded from database")
+        logger.debug("Game is loaded")
 
-        if not game:
+        if not snapshot or not any(p.user_id == user_id for p in snapshot.players):
             self.join(user_id)
-            game = self.get_game()
 
-        players = self.get_players()
+            # Don't cache this snapshot: the game won't be marked as changed
+            # until the session is committed
+            snapshot = self._load_snapshot(filter_by_activity=False)
 
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
-            logger.debug("Players: %s", [p.user.name for p in players])
+        state = render_state(snapshot, user_id, chat_since=chat_since)
 
-        try:
-            player = [p for p in players if p.user_id == user_id][0]
-        except IndexError:
-            self.join(user_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            t_end = time.time()
+            logger.debug(
+                f"Ending parse_game_to_state, duration = {t_end - t_start :.3f}s"
+            )
+
+        return state
+
+    @db_scoped
+    def get_state_update(
+        self,
+        user_id: UUID,
+        since_hash: Optional[int] = None,
+        chat_since: Optional[int] = None,
+    ) -> Union[FrontendState, FrontendStateDelta]:
+        """
+        Get the changes to the FrontendState for the user user_id since the
+        state with hash since_hash
 
-            game = self.get_game()
-            players = game.players
-            player = [p for p in players if p.user_id == user_id][0]
+        Returns a FrontendStateDelta if this worker still has the state that
+        was last sent to this user and its hash is since_hash. Otherwise
+        returns the full FrontendState, or only the chat messages newer than
+        chat_since if that's given.
+        """
+        state = self.parse_game_to_state(user_id)
 
-        logger.debug("Game: %s", game)
-        logger.debug("Player: %s", player)
-        logger.debug("User id: %s", user_id)
-        logger.debug("Game players: %s", players)
+        state_data = state.model_dump(mode="json")
+        previous = rendered_state_cache.get((self.game_id, user_id))
+        rendered_state_cache.put((self.game_id, user_id), state_data)
 
-        # Get the role description
-        apparant_role, role_details = get_apparant_role(player.role, game.stage)
+        if (
+            since_hash is not None
+            and previous is not None
+            and previous["state_hash"] == since_hash
+        ):
+            return FrontendStateDelta(
+                base_hash=since_hash,
+                state_hash=state.state_hash,
+                patch=make_json_patch(previous, state_data),
+            )
 
-        action_desc = role_details.get_stage_action(game.stage)
+        if chat_since is not None:
+            state.chat = [m for m in state.chat if m.id > chat_since]
+            state.chatSince = chat_since
 
-        has_action, action_enabled = self.player_has_action(
-            player, game.stage, game.stage_id
-        )
+        return state
 
-        logger.debug(
-            f"Player {player.user.name} is a {player.role.value}, has_action={has_action}, action_enabled={action_enabled}"
+    @db_scoped
+    def get_chat(self, user_id: UUID, since: int = 0) -> ChatUpdate:
+        """
+        Get the chat messages newer than the message with ID `since` which
+        are visible to the user user_id
+        """
+        snapshot = self.get_snapshot()
+        if not snapshot:
+            raise HTTPException(404, f"Game {self.game_id} not found")
+
+        player_id = next((p.id for p in snapshot.players if p.user_id == user_id), None)
+        if player_id is None:
+            player = self.get_player(user_id, filter_by_activity=False)
+            if not player:
+                raise HTTPException(404, f"Player {user_id} not found")
+            player_id = player.id
+
+        return ChatUpdate(
+            chat=render_chat(snapshot, player_id, since),
+            chatCursor=snapshot.chat_cursor,
+            chatStart=_get_chat_start(snapshot),
         )
 
-        controls_state = FrontendState.RoleState(
-            title=role_details.display_name,
-            text=action_desc.text[player.state],
-            role=apparant_role,
-            seed=player.seed,
-            button_visible=has_action,
-            button_enabled=action_enabled,
-            button_text=action_desc.button_text,
-            button_submit_person=action_desc.button_text and action_desc.select_person,
-            button_submit_func=get_action_func_name(player.role, game.stage),
-        )
 
-        logger.debug("role_details.stages: {}".format(role_details.stages))
-        logger.debug("action_desc: {}".format(action_desc))
-        logger.debug("controls_state: {}".format(controls_state))
+def render_chat(
+    snapshot: GameSnapshot, player_id: int, since: Optional[int] = None
+) -> List[FrontendState.ChatMsg]:
+    """
+    Get the messages in a GameSnapshot which are visible to this player,
+    optionally only those newer than the message with ID `since`
+    """
+    return [
+        FrontendState.ChatMsg.model_construct(id=m.id, msg=m.text, isStrong=m.is_strong)
+        for m in snapshot.messages
+        if (since is None or m.id > since)
+        and (not m.visible_to or player_id in m.visible_to)
+    ]
 
-        player_states = []
-        for p in players:
 
-            status = p.state
+def _get_chat_start(snapshot: GameSnapshot) -> int:
+    """
+    Get the ID of the oldest message still in the chat log. Clients should
+    drop any older messages that they hold.
+    """
+    if snapshot.messages:
+        return snapshot.messages[0].id
+    return snapshot.chat_cursor + 1
 
-            ready = False
-            if game.stage in [
-                GameStage.LOBBY,
-                GameStage.ENDED,
-                GameStage.VOTING,
-                GameStage.DAY,
-            ]:
-                has_action, action_enabled = self.player_has_action(
-                    p, game.stage, game.stage_id
-                )
-                if has_action and not action_enabled:
-                    ready = True
 
-            # Display real role if the game is ended or this player should be able to see it
-            real_role = p.role
-            if (
-                p.previous_role
-                and (p.role == PlayerRole.SPECTATOR or p.role == PlayerRole.NARRATOR)
-                and p.state != PlayerState.SPECTATING
-            ):
-                real_role = p.previous_role
-            displayed_role = PlayerRole.VILLAGER
-
-            # Only display as a spectator if the player is a spectator/narrator and had no
-            # previous role
-            if real_role == PlayerRole.SPECTATOR or real_role == PlayerRole.NARRATOR:
-                displayed_role = PlayerRole.SPECTATOR
-            elif p.id == player.id:
-                if player.state.is_dead():
-                    displayed_role = real_role
-                else:
-                    displayed_role = apparant_role
-            elif (
-                player.role == PlayerRole.NARRATOR
-                or (real_role == PlayerRole.WOLF and player.role == PlayerRole.WOLF)
-                or (real_role == PlayerRole.ACOLYTE and player.role == PlayerRole.WOLF)
-                or (real_role == PlayerRole.JESTER and player.role == PlayerRole.WOLF)
-                or (real_role == PlayerRole.MASON and player.role == PlayerRole.MASON)
-                or (real_role == PlayerRole.JESTER and p.state == PlayerState.LYNCHED)
-                or game.stage == GameStage.ENDED
-                or (
-                    real_role == PlayerRole.MAYOR
-                    and self.num_previous_stages(GameStage.NIGHT, game.stage_id) > 0
-                )
-            ):
-                displayed_role = real_role
+def render_state(
+    snapshot: GameSnapshot, user_id: UUID, chat_since: Optional[int] = None
+) -> FrontendState:
+    """
+    Project a GameSnapshot into the FrontendState seen by the user user_id
 
-            player_states.append(
-                FrontendState.UIPlayerState(
-                    id=p.user_id,
-                    name=p.user.name,
-                    status=status,
-                    role=displayed_role,
-                    seed=p.seed,
-                    selected=False,
-                    ready=ready,
-                )
-            )
+    This doesn't touch the database, so is cheap enough to run for every
+    player's request. If chat_since is given, only chat messages newer than
+    it are included: see FrontendState.chatSince.
 
-        # Random sort
-        player_states.sort(key=lambda s: s.seed)
+    The models are built without validation, since everything in them comes
+    from the (already validated) snapshot.
+    """
+    game = snapshot.game
+    players = snapshot.players
 
-        state = FrontendState(
-            state_hash=game.update_tag,
-            players=player_states,
-            chat=[
-                FrontendState.ChatMsg(msg=m.text, isStrong=m.is_strong)
-                for m in game.messages
-                if not m.expired
-                and ((not m.visible_to) or any(player.id == v.id for v in m.visible_to))
-            ],
-            showSecretChat=bool(role_details.secret_chat_enabled),
-            stage=game.stage,
-            controls_state=controls_state,
-            myID=user_id,
-            myName=player.user.name,
-            myNameIsGenerated=player.user.name_is_generated,
-            myStatus=player.state,
-            isCustomized=game.distribution_settings is not None,
-        )
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logger.debug("Players: %s", [p.user.name for p in players])
 
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("Full UI state: %s", state)
+    player = [p for p in players if p.user_id == user_id][0]
 
-            t_end = time.time()
-            logger.debug(
-                f"Ending parse_game_to_state, duration = {t_end - t_start :.3f}s"
+    logger.debug("Game: %s", game)
+    logger.debug("Player: %s", player)
+    logger.debug("User id: %s", user_id)
+    logger.debug("Game players: %s", players)
+
+    # Get the role description
+    apparant_role, role_details = get_apparant_role(player.role, game.stage)
+
+    action_desc = role_details.get_stage_action(game.stage)
+
+    player_actions = snapshot.actions[player.id]
+
+    logger.debug(
+        f"Player {player.user.name} is a {player.role.value}, has_action={player_actions.has_action}, action_enabled={player_actions.action_enabled}"
+    )
+
+    controls_state = FrontendState.RoleState.model_construct(
+        title=role_details.display_name,
+        text=action_desc.text[player.state],
+        role=apparant_role.value,
+        seed=player.seed,
+        button_visible=player_actions.has_action,
+        button_enabled=player_actions.action_enabled,
+        button_text=action_desc.button_text,
+        button_submit_person=action_desc.button_text and action_desc.select_person,
+        button_submit_func=get_action_func_name(player.role, game.stage),
+    )
+
+    logger.debug("role_details.stages: {}".format(role_details.stages))
+    logger.debug("action_desc: {}".format(action_desc))
+    logger.debug("controls_state: {}".format(controls_state))
+
+    player_states = []
+    for p in players:
+
+        status = p.state
+
+        ready = False
+        if game.stage in [
+            GameStage.LOBBY,
+            GameStage.ENDED,
+            GameStage.VOTING,
+            GameStage.DAY,
+        ]:
+            p_actions = snapshot.actions[p.id]
+            if p_actions.has_action and not p_actions.action_enabled:
+                ready = True
+
+        # Display real role if the game is ended or this player should be able to see it
+        real_role = p.role
+        if (
+            p.previous_role
+            and (p.role == PlayerRole.SPECTATOR or p.role == PlayerRole.NARRATOR)
+            and p.state != PlayerState.SPECTATING
+        ):
+            real_role = p.previous_role
+        displayed_role = PlayerRole.VILLAGER
+
+        # Only display as a spectator if the player is a spectator/narrator and had no
+        # previous role
+        if real_role == PlayerRole.SPECTATOR or real_role == PlayerRole.NARRATOR:
+            displayed_role = PlayerRole.SPECTATOR
+        elif p.id == player.id:
+            if player.state.is_dead():
+                displayed_role = real_role
+            else:
+                displayed_role = apparant_role
+        elif (
+            player.role == PlayerRole.NARRATOR
+            or (real_role == PlayerRole.WOLF and player.role == PlayerRole.WOLF)
+            or (real_role == PlayerRole.ACOLYTE and player.role == PlayerRole.WOLF)
+            or (real_role == PlayerRole.JESTER and player.role == PlayerRole.WOLF)
+            or (real_role == PlayerRole.MASON and player.role == PlayerRole.MASON)
+            or (real_role == PlayerRole.JESTER and p.state == PlayerState.LYNCHED)
+            or game.stage == GameStage.ENDED
+            or (real_role == PlayerRole.MAYOR and snapshot.num_previous_nights > 0)
+        ):
+            displayed_role = real_role
+
+        player_states.append(
+            FrontendState.UIPlayerState.model_construct(
+                id=p.user_id,
+                name=p.user.name,
+                status=status.value,
+                role=displayed_role.value,
+                seed=p.seed,
+                ready=ready,
             )
+        )
 
-        return state
+    # Random sort
+    player_states.sort(key=lambda s: s.seed)
+
+    state = FrontendState.model_construct(
+        state_hash=game.update_tag,
+        players=player_states,
+        chat=render_chat(snapshot, player.id, chat_since),
+        chatCursor=snapshot.chat_cursor,
+        chatStart=_get_chat_start(snapshot),
+        chatSince=chat_since,
+        showSecretChat=bool(role_details.secret_chat_enabled),
+        stage=game.stage,
+        controls_state=controls_state,
+        myID=user_id,
+        myName=player.user.name,
+        myNameIsGenerated=player.user.name_is_generated,
+        myStatus=player.state,
+        isCustomized=snapshot.is_customized,
+    )
+
+    logger.debug("Full UI state: %s", state)
+
+    return state
+
+
+def _warn_if_on_event_loop(func: Callable):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop in this thread: nothing to block
+        return
+
+    logger.warning(
+        "%s called from the event loop thread: this blocks all other requests. "
+        "Use database.run_in_db_thread.",
+        func.__name__,
+    )
 
 
 def trigger_update_event(game_id: int):
     logger.info(f"Triggering updates for game {game_id}")
-    global update_events
-    if game_id in update_events:
-        update_events[game_id].set()
-        del update_events[game_id]
+    snapshot_cache.pop(game_id)
+    notifications.get_notifier().notify(game_id)
 
 
 def _filter_by_activity(q):
     """
     Show all players who are active, and all players who have/had a non-spectator role,
     """
-    return q.filter(
-        or_(
-            Player.active,
-            Player.role != PlayerRole.SPECTATOR,
-            Player.previous_role != PlayerRole.SPECTATOR,
-        )
-    )
+    return q.filter(queries.PLAYER_IS_ACTIVE)
 
 
-def _player_is_active(p: Player):
+def _player_is_active(p: Union[Player, PlayerModel]):
     """
     Given a player, decide if they are active in the game
     """
@@ -0,0 +1,231 @@
+"""
+Instrumentation module
+
+Track the database work done by each HTTP request: the number of queries,
+the time spent in them, the number of ORM rows loaded and the time that game
+sessions were held open. Each request gets its own RequestMetrics, held in a
+context variable so that it follows the request into the threadpool used for
+sync routes.
+
+The metrics are reported to the client in a Server-Timing header and
+aggregated by route template (e.g. ``/api/{game_tag}/state``) for the
+``/api/metrics`` endpoint, which is in Prometheus text format.
+
+Metrics are recorded when the response starts, so work done while streaming
+a response body is not included.
+"""
+
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+from .model import Base
+
+# Label used for requests which didn't match any route
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RequestMetrics:
+    """Database work done while handling a single request"""
+
+    __slots__ = ["queries", "db_time", "rows", "session_time", "duration"]
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.session_time = 0.0
+        self.duration = 0.0
+
+    def server_timing(self) -> str:
+        """Format these metrics as a Server-Timing header value"""
+        return ", ".join(
+            [
+                f'db;dur={1e3 * self.db_time:.1f};desc="{self.queries} queries, {self.rows} rows"',
+                f"session;dur={1e3 * self.session_time:.1f}",
+                f"total;dur={1e3 * self.duration:.1f}",
+            ]
+        )
+
+
+class RouteStats:
+    """Totals of RequestMetrics for all requests to a route"""
+
+    __slots__ = ["requests", "duration", "queries", "db_time", "rows", "session_time"]
+
+    def __init__(self):
+        self.requests = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.session_time = 0.0
+
+    def add(self, metrics: RequestMetrics):
+        self.requests += 1
+        self.duration += metrics.duration
+        self.queries += metrics.queries
+        self.db_time += metrics.db_time
+        self.rows += metrics.rows
+        self.session_time += metrics.session_time
+
+
+_current_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "current_metrics", default=None
+)
+
+# (method, route template) -> RouteStats
+_route_stats: Dict[Tuple[str, str], RouteStats] = {}
+_route_stats_lock = threading.Lock()
+
+# Prometheus metric name, type, help text and RouteStats attribute
+PROMETHEUS_METRICS = [
+    ("wurwolves_requests_total", "counter", "Requests handled", "requests"),
+    (
+        "wurwolves_request_duration_seconds_total",
+        "counter",
+        "Time until the response started",
+        "duration",
+    ),
+    ("wurwolves_db_queries_total", "counter", "Database queries executed", "queries"),
+    (
+        "wurwolves_db_query_seconds_total",
+        "counter",
+        "Time spent executing database queries",
+        "db_time",
+    ),
+    ("wurwolves_db_rows_total", "counter", "ORM rows loaded", "rows"),
+    (
+        "wurwolves_db_session_seconds_total",
+        "counter",
+        "Time game database sessions were open",
+        "session_time",
+    ),
+]
+
+
+def current_metrics() -> Optional[RequestMetrics]:
+    """Get the metrics for the request being handled, if any"""
+    return _current_metrics.get()
+
+
+def record_session(duration: float) -> None:
+    """Record that a database session was open for duration seconds"""
+    metrics = _current_metrics.get()
+    if metrics:
+        metrics.session_time += duration
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_metrics.get():
+        conn.info.setdefault("instrumentation_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = _current_metrics.get()
+    starts = conn.info.get("instrumentation_start")
+    if metrics and starts:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - starts.pop(-1)
+
+
+@event.listens_for(Base, "load", propagate=True)
+def _on_load(target, context):
+    metrics = _current_metrics.get()
+    if metrics:
+        metrics.rows += 1
+
+
+def _get_route_template(scope) -> str:
+    """Find the path template of the route which handled this request"""
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return UNMATCHED_ROUTE
+
+    for route in app.routes:
+        if getattr(route, "endpoint", None) is endpoint:
+            return route.path
+
+    return UNMATCHED_ROUTE
+
+
+def _record_request(method: str, route: str, metrics: RequestMetrics):
+    with _route_stats_lock:
+        stats = _route_stats.get((method, route))
+        if stats is None:
+            stats = _route_stats[(method, route)] = RouteStats()
+        stats.add(metrics)
+
+
+def reset() -> None:
+    """Clear the aggregated metrics"""
+    with _route_stats_lock:
+        _route_stats.clear()
+
+
+def render_prometheus() -> str:
+    """Render the aggregated metrics in the Prometheus text format"""
+    from . import database
+
+    with _route_stats_lock:
+        stats = sorted(_route_stats.items())
+
+    lines = []
+    for name, metric_type, help_text, attribute in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (method, route), route_stats in stats:
+            value = getattr(route_stats, attribute)
+            lines.append(f'{name}{{method="{method}",route="{route}"}} {value}')
+
+    for key, value in database.pool_stats().items():
+        name = f"wurwolves_db_pool_{key}"
+        lines.append(f"# HELP {name} Connection pool {key.replace('_', ' ')}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware which collects RequestMetrics for each HTTP request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        t_start = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                metrics.duration = time.perf_counter() - t_start
+
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", metrics.server_timing())
+
+                _record_request(scope["method"], _get_route_template(scope), metrics)
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _current_metrics.reset(token)
@@ -1,7 +1,9 @@
+import asyncio
 import json
 import logging
 import os
 import random
+from contextlib import asynccontextmanager
 from typing import Optional
 
 import psutil
@@ -16,14 +18,26 @@ from fastapi import Path
 from fastapi import Query
 from fastapi import Request
 from fastapi import Response
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
 from starlette.middleware.sessions import SessionMiddleware
 
+from . import instrumentation
+from . import presence
+from .database import run_in_db_thread
+from .game import GET_HASH_TIMEOUT
 from .game import WurwolvesGame
+from .model import ChatUpdate
 from .model import DistributionSettings
 from .roles import RANDOMISED_ROLES
 from .roles import router as roles_router
 from .user_id import get_user_id
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger("main")
 
 # Set the root logger level to LOG_LEVEL if specified
@@ -39,7 +53,18 @@ WORDS_FILE = os.path.join(os.path.dirname(__file__), "words.txt")
 
 words = None
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Track player activity in the background, see the presence module
+    sweeper = asyncio.ensure_future(presence.run_sweeper())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 router = APIRouter()
 
 app.add_middleware(
@@ -47,25 +72,103 @@ app.add_middleware(
     secret_key="james will never understand the prostitute",
     max_age=60 * 60 * 24 * 365 * 10,
 )
+app.add_middleware(instrumentation.InstrumentationMiddleware)
 
 
 def get_mem_usage():
     return psutil.Process(os.getpid()).memory_info().rss / 1024**2
 
 
+def model_json(model: pydantic.BaseModel) -> bytes:
+    """
+    Serialise a model to JSON, using orjson if it's installed
+    """
+    if orjson is not None:
+        return orjson.dumps(model.model_dump())
+    return model.model_dump_json().encode()
+
+
+class ModelResponse(Response):
+    """
+    A JSON response containing a pydantic model
+
+    Returning a model from a route makes FastAPI convert it with
+    jsonable_encoder, which is slow for large models like FrontendState. Return
+    one of these from hot routes instead.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: pydantic.BaseModel) -> bytes:
+        return model_json(content)
+
+
+def state_etag(state_hash: int, user_id) -> str:
+    """
+    Make the ETag for the state of the game with this hash seen by this user
+    """
+    return f'"{state_hash}-{user_id}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return any(t.removeprefix("W/") == etag for t in tags)
+
+
 @router.get("/{game_tag}/state")
 async def get_state(
+    request: Request,
     game_tag: str = Path(..., title="The four-word ID of the game"),
+    since_hash: Optional[int] = Query(
+        None,
+        title="The state_hash of the client's current state. If provided, the changes since then may be returned as a FrontendStateDelta",
+    ),
+    chat_since: Optional[int] = Query(
+        None,
+        title="The chatCursor of the client's last state. If provided, only newer chat messages are returned",
+    ),
     user_id=Depends(get_user_id),
 ):
+    """
+    Get this user's FrontendState
+
+    The response has an ETag. If the client sends it back in If-None-Match and
+    the game hasn't changed, a 304 is returned after only checking the game's
+    hash.
+    """
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug("Starting get_state for UUID %s", user_id)
         logger.debug("get_state memory usage = %.0f MB", get_mem_usage())
 
-    state = WurwolvesGame(game_tag).parse_game_to_state(user_id)
+    game = WurwolvesGame(game_tag)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        current_hash = await game.get_hash()
+        etag = state_etag(current_hash, user_id)
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+    state = await run_in_db_thread(
+        game.get_state_update,
+        user_id,
+        since_hash=since_hash,
+        chat_since=chat_since,
+    )
     if not state:
         raise HTTPException(status_code=404, detail=f"Game '{game_tag}' not found")
-    return state
+
+    return ModelResponse(
+        state,
+        headers={
+            "ETag": state_etag(state.state_hash, user_id),
+            # Browsers may cache the state, but must check that it's current
+            "Cache-Control": "private, no-cache",
+        },
+    )
 
 
 @router.get("/default_role_weights")
@@ -82,7 +185,7 @@ async def get_game_config_mode(
 ):
     logger.info("Starting get_game_config for %s", game_tag)
 
-    return WurwolvesGame(game_tag).get_game_config_mode()
+    return await run_in_db_thread(WurwolvesGame(game_tag).get_game_config_mode)
 
 
 @router.post("/{game_tag}/game_config_mode")
@@ -96,7 +199,25 @@ async def set_game_config_mode(
     logger.info(
         "Starting set_game_config_mode for game %s, state %s", game_tag, new_config_mode
     )
-    WurwolvesGame(game_tag).set_game_config_mode(new_config_mode.lower())
+    await run_in_db_thread(
+        WurwolvesGame(game_tag).set_game_config_mode, new_config_mode.lower()
+    )
+
+
+@router.get("/{game_tag}/chat", response_model=ChatUpdate)
+async def get_chat(
+    game_tag: str = Path(..., title="The four-word ID of the game"),
+    since: int = Query(0, title="Only return messages newer than this ID"),
+    user_id=Depends(get_user_id),
+):
+    """
+    Get the chat messages visible to this user which are newer than `since`
+    """
+    logger.debug("Starting get_chat for UUID %s", user_id)
+
+    return ModelResponse(
+        await run_in_db_thread(WurwolvesGame(game_tag).get_chat, user_id, since)
+    )
 
 
 @router.post("/{game_tag}/chat")
@@ -129,10 +250,75 @@ async def get_state_hash(
         logger.debug("get_state_hash memory usage = %.0f MB", get_mem_usage())
 
     game = WurwolvesGame(game_tag)
-    game.player_keepalive(user_id)
+    await run_in_db_thread(game.player_keepalive, user_id)
     return await game.get_hash(known_hash=known_hash)
 
 
+async def state_events(
+    game_tag: str, user_id, is_disconnected, timeout=GET_HASH_TIMEOUT
+):
+    """
+    Generate Server-Sent Events containing this user's state
+
+    A "state" event containing the full FrontendState is sent immediately and
+    then again every time the game changes. Later events only contain the chat
+    messages which are new since the previous one (see FrontendState.chatSince).
+    While nothing is happening, a
+    comment is sent every `timeout` seconds to keep the connection (and the
+    player) alive. Stops when the awaitable `is_disconnected()` returns True.
+    """
+    known_hash = None
+    chat_cursor = None
+
+    while not await is_disconnected():
+        game = WurwolvesGame(game_tag)
+
+        try:
+            await run_in_db_thread(game.player_keepalive, user_id)
+            new_hash = await game.get_hash(known_hash=known_hash, timeout=timeout)
+
+            if new_hash == known_hash:
+                yield ": keepalive\n\n"
+                continue
+
+            # After the first event, only send new chat messages
+            state = await run_in_db_thread(
+                game.parse_game_to_state, user_id, chat_since=chat_cursor
+            )
+        except HTTPException as e:
+            yield f"event: error\ndata: {json.dumps(e.detail)}\n\n"
+            return
+
+        known_hash = state.state_hash
+        chat_cursor = state.chatCursor
+        yield f"event: state\ndata: {model_json(state).decode()}\n\n"
+
+
+@router.get("/{game_tag}/state_stream")
+async def get_state_stream(
+    request: Request,
+    game_tag: str = Path(..., title="The four-word ID of the game"),
+    user_id=Depends(get_user_id),
+):
+    """
+    Stream this user's state as Server-Sent Events
+
+    This replaces polling state_hash then fetching state: the state is pushed
+    as soon as it changes. See `state_events` for the format.
+    """
+    logger.debug("Starting get_state_stream for UUID %s", user_id)
+
+    # Check the player exists before the stream starts, so that we can still
+    # return a 404 if not
+    await run_in_db_thread(WurwolvesGame(game_tag).player_keepalive, user_id)
+
+    return StreamingResponse(
+        state_events(game_tag, user_id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/{game_tag}/join")
 async def join(
     game_tag: str = Path(..., title="The four-word ID of the game"),
@@ -140,7 +326,7 @@ async def join(
 ):
     logger.debug("Starting join for UUID %s", user_id)
 
-    WurwolvesGame(game_tag).join(user_id)
+    await run_in_db_thread(WurwolvesGame(game_tag).join, user_id)
 
 
 @router.post("/{game_tag}/end_game")
@@ -150,10 +336,13 @@ async def end_game(
 ):
     logger.debug("Starting end_game for UUID %s", user_id)
 
-    g = WurwolvesGame(game_tag)
-    user_name = g.get_user_name(user_id)
-    g.send_chat_message(f"The game was ended early by {user_name}", is_strong=True)
-    g.end_game()
+    def _end_game():
+        g = WurwolvesGame(game_tag)
+        user_name = g.get_user_name(user_id)
+        g.send_chat_message(f"The game was ended early by {user_name}", is_strong=True)
+        g.end_game()
+
+    await run_in_db_thread(_end_game)
 
 
 @router.post("/set_name")
@@ -165,7 +354,7 @@ async def set_name(
 ):
     logger.debug("Starting set_name for UUID %s", user_id)
 
-    WurwolvesGame.set_user_name(user_id, name)
+    await run_in_db_thread(WurwolvesGame.set_user_name, user_id, name)
 
 
 @router.get("/my_id")
@@ -194,6 +383,17 @@ async def get_game():
     )
 
 
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Get database usage by route, in Prometheus text format
+    """
+    return PlainTextResponse(
+        instrumentation.render_prometheus(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 @router.get("/hello")
 def hello():
     return {"msg": "Hello world!"}
@@ -3,6 +3,7 @@ import enum
 import json
 import logging
 import random
+from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import List
@@ -18,14 +19,14 @@ from sqlalchemy import DateTime
 from sqlalchemy import Enum
 from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
-from sqlalchemy import Table
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.types import VARCHAR
-from sqlalchemy_utils import UUIDType
+from sqlalchemy_utils import UUIDType as BaseUUIDType
 
 from .utils import hash_str_to_int
 
@@ -43,6 +44,7 @@ class JSONEncodedDict(TypeDecorator):
     """
 
     impl = VARCHAR
+    cache_ok = True
 
     class UUIDEncoder(json.JSONEncoder):
         def default(self, obj):
@@ -63,6 +65,18 @@ class JSONEncodedDict(TypeDecorator):
         return value
 
 
+class UUIDType(BaseUUIDType):
+    """
+    sqlalchemy_utils' UUIDType, marked as safe to cache
+
+    SQLAlchemy only caches the compiled form of statements whose types declare
+    `cache_ok` themselves. Without this, every query comparing a user ID is
+    compiled again.
+    """
+
+    cache_ok = True
+
+
 class GameStage(str, enum.Enum):
     LOBBY = "LOBBY"
     DAY = "DAY"
@@ -188,6 +202,13 @@ class Player(Base):
         cascade="all, delete-orphan",
     )
 
+    __table_args__ = (
+        # Players are looked up within a game by their user
+        Index("ix_players_game_id_user_id", game_id, user_id),
+        # The presence sweep finds the games with recently seen players
+        Index("ix_players_last_seen_game_id", last_seen, game_id),
+    )
+
     def touch(self):
         self.last_seen = datetime.datetime.now()
 
@@ -215,6 +236,13 @@ class Action(Base):
     player = relationship("Player", lazy=True, foreign_keys=player_id)
     selected_player = relationship("Player", lazy=True, foreign_keys=selected_player_id)
 
+    # Actions are read for the current stage of a game, ignoring expired ones.
+    # IDs must never be reused, since expired actions are moved to the archive.
+    __table_args__ = (
+        Index("ix_actions_game_id_stage_id_expired", game_id, stage_id, expired),
+        {"sqlite_autoincrement": True},
+    )
+
 
 class User(Base):
     """
@@ -233,15 +261,6 @@ class User(Base):
     player_roles = relationship("Player", lazy=True)
 
 
-# many-to-many relationship between players and messages
-association_table = Table(
-    "message_visibility",
-    Base.metadata,
-    Column("player_id", Integer, ForeignKey("players.id")),
-    Column("message_id", Integer, ForeignKey("messages.id")),
-)
-
-
 class Message(Base):
     """
     A message in the chatlog of a game. Each Game can have many Messages.
@@ -256,10 +275,66 @@ class Message(Base):
     game_id = Column(Integer, ForeignKey("games.id"), nullable=False)
     is_strong = Column(Boolean, default=False)
 
-    visible_to = relationship("Player", secondary=association_table, lazy="joined")
+    # IDs of the Players who can see this message, or None if everyone can.
+    # Stored inline so that reading the chat log doesn't need a join
+    recipients = Column(JSONEncodedDict, default=None)
 
     expired = Column(Boolean, default=False)
 
+    # Chat logs are read in order, and from a cursor, without expired messages.
+    # IDs must never be reused, since clients' cursors refer to them and
+    # expired messages are moved to the archive.
+    __table_args__ = (
+        Index("ix_messages_game_id_id", game_id, id),
+        Index("ix_messages_game_id_expired_id", game_id, expired, id),
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ArchivedAction(Base):
+    """
+    An expired Action, moved out of the live table by backend.archive
+
+    Rows are only ever appended. There are no foreign keys, so that players and
+    games can be deleted without touching their history.
+    """
+
+    __tablename__ = "actions_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    time_created = Column(DateTime)
+    time_archived = Column(DateTime, server_default=func.now())
+
+    game_id = Column(Integer, index=True)
+    player_id = Column(Integer)
+    stage_id = Column(Integer, nullable=False)
+    selected_player_id = Column(Integer, nullable=True)
+    stage = Column(Enum(GameStage), nullable=False)
+    role = Column(Enum(PlayerRole), nullable=False)
+    random_field = Column(Integer)
+
+
+class ArchivedMessage(Base):
+    """
+    An expired Message, moved out of the live table by backend.archive
+
+    Rows are only ever appended. See ArchivedAction.
+    """
+
+    __tablename__ = "messages_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    time_created = Column(DateTime)
+    time_archived = Column(DateTime, server_default=func.now())
+
+    game_id = Column(Integer, nullable=False)
+    text = Column(String)
+    is_strong = Column(Boolean)
+    recipients = Column(JSONEncodedDict)
+
+    # The last archived message is the chat cursor of a game with an empty log
+    __table_args__ = (Index("ix_messages_archive_game_id_id", game_id, id),)
+
 
 def hash_game_tag(text: str):
     """Hash a game id into a 3-byte integer
@@ -302,7 +377,7 @@ class MessageModel(pydantic.BaseModel):
     is_strong: bool
     expired: bool
 
-    visible_to: List[PlayerModel]
+    recipients: Optional[List[int]] = None
 
     class Config:
         from_attributes = True
@@ -336,7 +411,14 @@ class UserModel(pydantic.BaseModel):
         extra = "forbid"
 
 
-class ActionModel(pydantic.BaseModel):
+class SlimActionModel(pydantic.BaseModel):
+    """
+    An Action without its relationships
+
+    Use this where only IDs are needed: loading the related game embeds every
+    player and message in it.
+    """
+
     id: int
     game_id: int
     player_id: int
@@ -344,6 +426,12 @@ class ActionModel(pydantic.BaseModel):
     selected_player_id: Union[int, None]
     stage: GameStage
 
+    class Config:
+        from_attributes = True
+        extra = "forbid"
+
+
+class ActionModel(SlimActionModel):
     game: GameModel
     player: PlayerModel
     selected_player: Union[None, PlayerModel]
@@ -410,10 +498,19 @@ class FrontendState(pydantic.BaseModel):
     players: List[UIPlayerState]
 
     class ChatMsg(pydantic.BaseModel):
+        id: int
         msg: str
         isStrong: bool = False
 
     chat: List[ChatMsg]
+    # ID of the newest message in the game. Pass this as chat_since to only
+    # receive newer messages
+    chatCursor: int = 0
+    # ID of the oldest message still in the chat log. Clients should drop
+    # any older messages
+    chatStart: int = 0
+    # If set, chat only contains the messages newer than this ID
+    chatSince: Optional[int] = None
     showSecretChat: bool = False
 
     stage: GameStage
@@ -454,4 +551,25 @@ class FrontendState(pydantic.BaseModel):
     isCustomized: bool
 
 
+class FrontendStateDelta(pydantic.BaseModel):
+    """
+    The changes to a client's FrontendState since the state with base_hash,
+    as a JSON patch (RFC 6902)
+    """
+
+    base_hash: int
+    state_hash: int
+    patch: List[Dict[str, Any]]
+
+
+class ChatUpdate(pydantic.BaseModel):
+    """
+    Chat messages newer than a cursor. See FrontendState for the fields
+    """
+
+    chat: List[FrontendState.ChatMsg]
+    chatCursor: int
+    chatStart: int
+
+
 PlayerModel.update_forward_refs()
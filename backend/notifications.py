@@ -0,0 +1,341 @@
+"""
+Notifications module
+
+Long-polling requests wait in ``WurwolvesGame.get_hash`` until their game
+changes. This module provides the machinery which wakes them up.
+
+Each process has a single notifier, returned by :func:`get_notifier`. Waiters
+subscribe to a game ID with :meth:`NotificationBackend.wait` and are woken
+when :meth:`NotificationBackend.notify` is called for that game. Waiters which
+need to check the game before waiting should subscribe first with
+:meth:`NotificationBackend.subscribe`, so that changes made while they check
+aren't missed. The local
+backend only reaches waiters in the same process, which is fine for SQLite
+and for tests. When running several workers against Postgres, the Postgres
+backend also broadcasts changes with LISTEN/NOTIFY so that waiters in every
+worker are woken.
+
+The backend can be forced with the NOTIFICATION_BACKEND environment variable
+("local" or "postgres"). By default it is chosen from the database dialect.
+
+A notifier which hears about every change to every game, from any worker, can
+also cache games' update tags so that idle long-polls don't need to query the
+database at all: see :meth:`NotificationBackend.get_cached_hash`. Only the
+Postgres backend does so, and only while its listener is connected.
+"""
+
+import asyncio
+import logging
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from uuid import uuid4
+
+from .utils import LRUCache
+
+logger = logging.getLogger("notifications")
+
+# Postgres channel used to broadcast game updates between workers
+POSTGRES_CHANNEL = "wurwolves_updates"
+
+# Time between checks that the listener connection is still alive
+LISTEN_POLL_INTERVAL = 5
+
+# Time to wait before reconnecting if the listener connection drops
+LISTEN_RECONNECT_DELAY = 1
+
+# Number of games' update tags to cache
+HASH_CACHE_SIZE = int(os.environ.get("HASH_CACHE_SIZE", 4096))
+
+# Seconds before a cached update tag is read again, in case a notification was lost
+HASH_CACHE_TTL = float(os.environ.get("HASH_CACHE_TTL", 30))
+
+_notifier: Optional["NotificationBackend"] = None
+_notifier_engine = None
+_notifier_lock = threading.Lock()
+
+
+class NotificationBackend:
+    """
+    Deliver "game X has changed" messages to subscribers in this process
+
+    Waiters may be running in any event loop and notifications may be sent from
+    any thread (sync routes run in a threadpool), so waking is always done with
+    ``call_soon_threadsafe``.
+    """
+
+    # Does this backend reach waiters in other processes?
+    broadcasts_across_processes = False
+
+    def __init__(self):
+        self._waiters: Dict[
+            int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]
+        ] = {}
+        self._lock = threading.Lock()
+
+        self._hashes = LRUCache(max_size=HASH_CACHE_SIZE, ttl=HASH_CACHE_TTL)
+        # Number of notifications received: see hash_token
+        self._num_notifications = 0
+
+    @contextmanager
+    def subscribe(self, game_id: int) -> Iterator[asyncio.Event]:
+        """
+        Subscribe to changes to game_id for the duration of this context
+
+        The yielded event is set by the first notification received. Pass it
+        to :func:`wait_for_event` to wait for it.
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+
+        with self._lock:
+            self._waiters.setdefault(game_id, set()).add(waiter)
+            logger.debug("Subscribed to game %s", game_id)
+
+        try:
+            yield waiter[1]
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(game_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[game_id]
+
+    async def wait(self, game_id: int, timeout: float) -> bool:
+        """
+        Wait for up to timeout seconds for a change to game_id
+
+        Returns True if a notification was received, False if the wait timed out
+        """
+        with self.subscribe(game_id) as changed:
+            return await wait_for_event(changed, timeout)
+
+    def notify(self, game_id: int) -> None:
+        """Mark game_id as changed, waking all its subscribers"""
+        self._wake_local(game_id)
+
+    def can_cache_hashes(self) -> bool:
+        """
+        Will this notifier hear about every change to every game?
+        """
+        return False
+
+    def get_cached_hash(self, game_id: int) -> Optional[int]:
+        """
+        Get the update tag of game_id if it's known to be current, else None
+        """
+        if not self.can_cache_hashes():
+            return None
+        return self._hashes.get(game_id)
+
+    def hash_token(self) -> int:
+        """
+        Get a token to pass to cache_hash, taken before reading an update tag
+        """
+        with self._lock:
+            return self._num_notifications
+
+    def cache_hash(self, game_id: int, update_tag: int, token: int) -> None:
+        """
+        Cache an update tag which was read after taking `token`
+
+        It's discarded if any notification has arrived since, since the tag
+        might have been read before the change.
+        """
+        with self._lock:
+            if token == self._num_notifications and self.can_cache_hashes():
+                self._hashes.put(game_id, update_tag)
+
+    def _forget_hashes(self) -> None:
+        with self._lock:
+            self._num_notifications += 1
+            self._hashes.clear()
+
+    def _wake_local(self, game_id: int) -> None:
+        with self._lock:
+            self._num_notifications += 1
+            self._hashes.pop(game_id)
+            waiters = self._waiters.pop(game_id, set())
+
+        if waiters:
+            logger.debug("Waking %s subscribers to game %s", len(waiters), game_id)
+
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiter's loop has been closed: nothing to wake
+                pass
+
+
+class LocalNotificationBackend(NotificationBackend):
+    """
+    Notify waiters in this process only
+
+    Used for SQLite and for testing. If several workers are running, a waiter
+    in a different worker to the one that made a change will only see it when
+    its wait times out.
+    """
+
+
+class PostgresNotificationBackend(NotificationBackend):
+    """
+    Notify waiters in all processes using Postgres LISTEN/NOTIFY
+
+    Changes are delivered locally straight away, then broadcast on
+    POSTGRES_CHANNEL. A daemon thread in each process listens on the channel
+    and wakes its local waiters. Messages are tagged with a token identifying
+    the sending process so that local changes aren't delivered twice.
+    """
+
+    broadcasts_across_processes = True
+
+    def __init__(self, engine):
+        super().__init__()
+        self._engine = engine
+        self._token = uuid4().hex
+        self._listener: Optional[threading.Thread] = None
+        self._listener_lock = threading.Lock()
+        self._listening = False
+
+    def subscribe(self, game_id: int):
+        self.start_listening()
+        return super().subscribe(game_id)
+
+    def can_cache_hashes(self) -> bool:
+        return self._listening
+
+    def notify(self, game_id: int) -> None:
+        from sqlalchemy import text
+
+        super().notify(game_id)
+
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {
+                        "channel": POSTGRES_CHANNEL,
+                        "payload": f"{self._token}:{game_id}",
+                    },
+                )
+        except Exception:
+            # Other workers will still pick up the change when their waits time out
+            logger.exception("Failed to broadcast update for game %s", game_id)
+
+    def start_listening(self) -> None:
+        """Start the listener thread if it isn't already running"""
+        with self._listener_lock:
+            if self._listener and self._listener.is_alive():
+                return
+
+            self._listener = threading.Thread(
+                target=self._listen_forever, name="wurwolves-listener", daemon=True
+            )
+            self._listener.start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception(
+                    "Postgres listener failed: reconnecting in %ss",
+                    LISTEN_RECONNECT_DELAY,
+                )
+                time.sleep(LISTEN_RECONNECT_DELAY)
+
+    def _listen(self):
+        # Take a connection out of the pool permanently: it will be blocked
+        # waiting for notifications for the life of the process
+        raw_connection = self._engine.raw_connection()
+        raw_connection.detach()
+        dbapi_connection = raw_connection.connection
+
+        try:
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {POSTGRES_CHANNEL}")
+
+            logger.info("Listening for updates on %s", POSTGRES_CHANNEL)
+            self._listening = True
+
+            while True:
+                readable, _, _ = select.select(
+                    [dbapi_connection], [], [], LISTEN_POLL_INTERVAL
+                )
+                if not readable:
+                    continue
+
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    self._handle_payload(dbapi_connection.notifies.pop(0).payload)
+        finally:
+            # Notifications may be missed until we're listening again
+            self._listening = False
+            self._forget_hashes()
+            dbapi_connection.close()
+
+    def _handle_payload(self, payload: str):
+        try:
+            token, game_id = payload.split(":")
+            game_id = int(game_id)
+        except ValueError:
+            logger.warning("Ignoring malformed notification '%s'", payload)
+            return
+
+        if token != self._token:
+            self._wake_local(game_id)
+
+
+async def wait_for_event(event: asyncio.Event, timeout: float) -> bool:
+    """
+    Wait for up to timeout seconds for event to be set
+
+    Returns True if it was set, False if the wait timed out
+    """
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def make_notifier(engine) -> NotificationBackend:
+    """Build the notification backend appropriate for this engine"""
+    backend = os.environ.get("NOTIFICATION_BACKEND")
+
+    if backend is None:
+        backend = "postgres" if engine.dialect.name == "postgresql" else "local"
+
+    if backend == "postgres":
+        logger.info("Using Postgres notification backend")
+        return PostgresNotificationBackend(engine)
+    elif backend == "local":
+        logger.info("Using local notification backend")
+        return LocalNotificationBackend()
+    else:
+        raise ValueError(f"Unknown NOTIFICATION_BACKEND '{backend}'")
+
+
+def get_notifier() -> NotificationBackend:
+    """Get the notifier for this process, making it if required"""
+    from . import database
+
+    global _notifier
+    global _notifier_engine
+
+    with _notifier_lock:
+        # Rebuild the notifier if the database has been reloaded
+        if _notifier is None or _notifier_engine is not database.engine:
+            _notifier = make_notifier(database.engine)
+            _notifier_engine = database.engine
+
+        return _notifier
@@ -0,0 +1,330 @@
+"""
+Presence module
+
+Track which players are still connected without writing to the database on
+every poll. Each call to WurwolvesGame.player_keepalive records a heartbeat
+in this worker's PresenceStore. A background task, `run_sweeper`, is started
+with the app and every PRESENCE_SWEEP_INTERVAL seconds:
+
+* flushes every heartbeat received since the last flush to `Player.last_seen`
+  in one batched UPDATE, then
+* sweeps the games which still have someone polling, i.e. at least one player
+  seen recently. Players whose `active` flag no longer matches their
+  last_seen are flipped in one bulk UPDATE and only the games where a flag
+  changed are touched and have their actions reprocessed.
+
+`Player.last_seen` stays the source of truth shared between workers. A
+connected client polls at least every GET_HASH_TIMEOUT seconds and its worker
+writes the heartbeat within PRESENCE_SWEEP_INTERVAL, so last_seen lags a live
+player by at most their sum: see max_last_seen_lag. Players are only judged
+inactive once last_seen is older than both this and the spectator timeout
+(see stale_threshold), so a heartbeat which another worker hasn't flushed yet
+can't get a live player marked inactive. Every worker flushes its own
+heartbeats, but only one at a time may sweep: this is enforced by a Postgres
+advisory lock, or by a lock in this process for other databases.
+
+Heartbeats are only accepted for players whose existence was checked against
+the database within the last PRESENCE_VERIFY_INTERVAL seconds. Otherwise
+player_keepalive falls back to checking and touching the player directly.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+from uuid import UUID
+
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import not_
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import update
+
+from .model import Player
+
+# Seconds between sweeps of the presence store
+PRESENCE_SWEEP_INTERVAL = float(os.environ.get("PRESENCE_SWEEP_INTERVAL", 10))
+
+# Seconds for which a player is trusted to exist before the database is checked again
+PRESENCE_VERIFY_INTERVAL = float(os.environ.get("PRESENCE_VERIFY_INTERVAL", 60))
+
+# Key of the Postgres advisory lock held while sweeping
+PRESENCE_SWEEP_LOCK_KEY = 0x77757277
+
+logger = logging.getLogger("presence")
+
+_sweep_lock = threading.Lock()
+
+
+class _Presence:
+    __slots__ = ["player_id", "verified", "flushed", "heartbeat"]
+
+    def __init__(self, player_id: int, last_seen: datetime.datetime):
+        self.player_id = player_id
+        self.verified = time.monotonic()
+        self.flushed = last_seen
+        self.heartbeat = last_seen
+
+
+class PresenceStore:
+    """
+    Latest heartbeats of the players known to this worker
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # game_id -> user_id -> _Presence
+        self._games: Dict[int, Dict[UUID, _Presence]] = {}
+
+    def remember(
+        self,
+        game_id: int,
+        user_id: UUID,
+        player_id: int,
+        last_seen: datetime.datetime,
+    ) -> None:
+        """
+        Record that this player exists and has been seen at `last_seen`,
+        which is already stored in the database
+        """
+        with self._lock:
+            self._games.setdefault(game_id, {})[user_id] = _Presence(
+                player_id, last_seen
+            )
+
+    def heartbeat(self, game_id: int, user_id: UUID) -> bool:
+        """
+        Record a heartbeat from this user
+
+        Returns False, without recording anything, if the player's existence
+        needs to be checked against the database first
+        """
+        with self._lock:
+            presence = self._games.get(game_id, {}).get(user_id)
+
+            if (
+                presence is None
+                or time.monotonic() - presence.verified > PRESENCE_VERIFY_INTERVAL
+            ):
+                return False
+
+            presence.heartbeat = datetime.datetime.now()
+
+            return True
+
+    def forget_player(self, game_id: int, player_id: int) -> None:
+        """
+        Forget a player, so that their next keepalive checks the database
+        """
+        with self._lock:
+            players = self._games.get(game_id, {})
+            for user_id, presence in list(players.items()):
+                if presence.player_id == player_id:
+                    del players[user_id]
+
+    def get_heartbeats(self, game_id: int) -> Dict[int, datetime.datetime]:
+        """
+        Get the latest heartbeat of each player in this game known to this
+        worker, keyed by player ID
+        """
+        with self._lock:
+            return {
+                presence.player_id: presence.heartbeat
+                for presence in self._games.get(game_id, {}).values()
+            }
+
+    def collect(self) -> List[Tuple[int, datetime.datetime]]:
+        """
+        Get the (player_id, last_seen) pairs which are due to be written, i.e.
+        all heartbeats received since the last collection
+
+        Players who need to be verified again are forgotten, so that the
+        store doesn't grow forever.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            due = []
+            for game_id, players in list(self._games.items()):
+                for user_id, presence in list(players.items()):
+                    if presence.heartbeat > presence.flushed:
+                        due.append((presence.player_id, presence.heartbeat))
+                        presence.flushed = presence.heartbeat
+
+                    if now - presence.verified > PRESENCE_VERIFY_INTERVAL:
+                        del players[user_id]
+
+                if not players:
+                    del self._games[game_id]
+
+            return due
+
+    def clear(self) -> None:
+        with self._lock:
+            self._games.clear()
+
+
+store = PresenceStore()
+
+
+def flush_last_seen(due: List[Tuple[int, datetime.datetime]]) -> None:
+    """
+    Write players' last_seen times in a single batched UPDATE
+
+    Values are only ever moved forwards, since another worker may have
+    written a later heartbeat.
+    """
+    from . import database
+
+    if not due:
+        return
+
+    statement = (
+        update(Player.__table__)
+        .where(Player.id == bindparam("player_id"))
+        .where(or_(Player.last_seen.is_(None), Player.last_seen < bindparam("seen_at")))
+        .values(last_seen=bindparam("seen_at"))
+    )
+
+    with database.engine.begin() as connection:
+        connection.execute(
+            statement,
+            [
+                {"player_id": player_id, "seen_at": seen_at}
+                for player_id, seen_at in due
+            ],
+        )
+
+
+def max_last_seen_lag() -> datetime.timedelta:
+    """
+    The longest that a connected player's last_seen in the database can lag
+    behind real time
+
+    Clients poll at least every GET_HASH_TIMEOUT seconds and each worker
+    flushes its heartbeats every PRESENCE_SWEEP_INTERVAL seconds.
+    """
+    from .game import GET_HASH_TIMEOUT
+
+    return datetime.timedelta(seconds=GET_HASH_TIMEOUT + PRESENCE_SWEEP_INTERVAL)
+
+
+def stale_threshold() -> datetime.datetime:
+    """
+    Players last seen at or before this time are no longer connected
+    """
+    from .game import SPECTATOR_TIMEOUT
+
+    return datetime.datetime.utcnow() - max(SPECTATOR_TIMEOUT, max_last_seen_lag())
+
+
+def _try_lock_sweep(connection) -> bool:
+    """
+    Try to take the lock which allows a worker to sweep, for the duration of
+    this connection's transaction
+    """
+    if connection.dialect.name != "postgresql":
+        return True
+
+    return connection.execute(
+        text("SELECT pg_try_advisory_xact_lock(:key)"),
+        {"key": PRESENCE_SWEEP_LOCK_KEY},
+    ).scalar()
+
+
+def sweep_activity() -> Set[int]:
+    """
+    Mark stale players as inactive, and fresh ones as active, in all games
+    which still have someone polling
+
+    Returns the IDs of the games in which a player's flag changed. Returns an
+    empty set if another worker is already sweeping.
+    """
+    from . import database
+
+    if not _sweep_lock.acquire(blocking=False):
+        return set()
+
+    try:
+        with database.engine.begin() as connection:
+            if not _try_lock_sweep(connection):
+                logger.debug("Another worker is sweeping")
+                return set()
+
+            threshold = stale_threshold()
+            is_stale = Player.last_seen <= threshold
+
+            polled_games = select(Player.game_id).where(Player.last_seen > threshold)
+
+            flipped = connection.execute(
+                select(Player.id, Player.game_id, Player.active)
+                .where(Player.game_id.in_(polled_games))
+                .where(
+                    or_(
+                        and_(Player.active, is_stale),
+                        and_(not_(Player.active), not_(is_stale)),
+                    )
+                )
+            ).all()
+
+            if not flipped:
+                return set()
+
+            connection.execute(
+                update(Player.__table__)
+                .where(Player.id.in_([row.id for row in flipped]))
+                .values(active=not_(Player.active))
+            )
+    finally:
+        _sweep_lock.release()
+
+    for row in flipped:
+        logger.info(
+            "Marking player %s in game %s as %s",
+            row.id,
+            row.game_id,
+            "inactive" if row.active else "active",
+        )
+        if row.active:
+            # Check they still exist when they next poll
+            store.forget_player(row.game_id, row.id)
+
+    return {row.game_id for row in flipped}
+
+
+def sweep() -> None:
+    """
+    Flush this worker's heartbeats to the database, then sweep for players
+    whose activity has changed and reprocess their games
+    """
+    from .game import WurwolvesGame
+
+    flush_last_seen(store.collect())
+
+    for game_id in sweep_activity():
+        try:
+            WurwolvesGame.from_id(game_id).activity_changed()
+        except Exception:
+            logger.exception("Failed to process activity change in game %s", game_id)
+
+
+async def run_sweeper(interval: float = PRESENCE_SWEEP_INTERVAL) -> None:
+    """
+    Sweep the presence store every `interval` seconds, until cancelled
+    """
+    from .database import run_in_db_thread
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_db_thread(sweep)
+        except Exception:
+            logger.exception("Presence sweep failed")
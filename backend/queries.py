@@ -0,0 +1,148 @@
+"""
+Queries module
+
+Statements for the lookups on the game's hot paths, built once at import.
+
+SQLAlchemy caches the compiled form of every statement in the engine that
+runs it, keyed by the statement's structure, so each engine compiles these
+at most once. Values are always passed as bound parameters and never built
+into the statements, so that they all share the same cache entry. Lookups by
+primary key use Session.get, which also checks the session's identity map
+before going to the database.
+"""
+
+from typing import List
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import bindparam
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload
+
+from .model import Action
+from .model import Game
+from .model import Player
+from .model import PlayerRole
+from .model import User
+
+# Relationships to load with a Game, for each hot path which uses it. See
+# get_game. A game's players are few, so are joined to the game row. Messages
+# and actions can be many, so are fetched in one further query each rather
+# than multiplying the joined rows.
+GAME_LOADER_PROFILES = {
+    # Building a GameSnapshot (players come with their users)
+    "render": (
+        joinedload(Game.players),
+        selectinload(Game.messages),
+        selectinload(Game.actions),
+    ),
+    # Checking and resolving the actions of a stage
+    "resolve": (
+        joinedload(Game.players),
+        selectinload(Game.actions),
+    ),
+    # Updating players' activity: their users are only needed for logging
+    "keepalive": (joinedload(Game.players).lazyload(Player.user),),
+}
+
+# Show all players who are active, and all players who have/had a non-spectator role
+PLAYER_IS_ACTIVE = or_(
+    Player.active,
+    Player.role != PlayerRole.SPECTATOR,
+    Player.previous_role != PlayerRole.SPECTATOR,
+)
+
+GAME_BY_ID = select(Game).where(Game.id == bindparam("game_id"))
+
+_GAME_BY_ID_PROFILES = {
+    profile: GAME_BY_ID.options(*options)
+    for profile, options in GAME_LOADER_PROFILES.items()
+}
+
+HASH_BY_GAME_ID = select(Game.update_tag).where(Game.id == bindparam("game_id"))
+
+_PLAYER_IN_GAME = (
+    Player.game_id == bindparam("game_id"),
+    Player.user_id == bindparam("user_id"),
+)
+
+PLAYER_BY_GAME_AND_USER = select(Player).where(*_PLAYER_IN_GAME)
+
+ACTIVE_PLAYER_BY_GAME_AND_USER = PLAYER_BY_GAME_AND_USER.where(PLAYER_IS_ACTIVE)
+
+PLAYER_ID_BY_GAME_AND_USER = select(Player.id).where(*_PLAYER_IN_GAME)
+
+ACTIONS_BY_STAGE = (
+    select(Action)
+    .where(
+        Action.game_id == bindparam("game_id"),
+        Action.stage_id == bindparam("stage_id"),
+        Action.expired == False,
+    )
+    .order_by(Action.id)
+)
+
+
+def get_game(session, game_id: int, profile: Optional[str] = None) -> Optional[Game]:
+    """
+    Get a Game, loading the relationships listed by the given profile in
+    GAME_LOADER_PROFILES. Without a profile, they're loaded lazily when
+    accessed.
+    """
+    statement = _GAME_BY_ID_PROFILES[profile] if profile else GAME_BY_ID
+
+    return session.execute(statement, {"game_id": game_id}).unique().scalars().first()
+
+
+def get_hash(session, game_id: int) -> Optional[int]:
+    """
+    Get the update_tag of a game without loading it
+
+    `session` may also be a Connection, to avoid using the ORM at all.
+    """
+    return session.execute(HASH_BY_GAME_ID, {"game_id": game_id}).scalar()
+
+
+def get_player(
+    session, game_id: int, user_id: UUID, active_only=False
+) -> Optional[Player]:
+    """
+    Get a user's Player in a game. If `active_only`, only return them if they
+    should be displayed (see PLAYER_IS_ACTIVE).
+    """
+    statement = (
+        ACTIVE_PLAYER_BY_GAME_AND_USER if active_only else PLAYER_BY_GAME_AND_USER
+    )
+
+    return (
+        session.execute(statement, {"game_id": game_id, "user_id": user_id})
+        .scalars()
+        .first()
+    )
+
+
+def get_player_id(session, game_id: int, user_id: UUID) -> Optional[int]:
+    return session.execute(
+        PLAYER_ID_BY_GAME_AND_USER, {"game_id": game_id, "user_id": user_id}
+    ).scalar()
+
+
+def get_player_by_id(session, player_id: int) -> Optional[Player]:
+    return session.get(Player, player_id)
+
+
+def get_user(session, user_id: UUID) -> Optional[User]:
+    return session.get(User, user_id)
+
+
+def get_stage_actions(session, game_id: int, stage_id: int) -> List[Action]:
+    """
+    Get the unexpired Actions of a stage, in the order they were submitted
+    """
+    return (
+        session.execute(ACTIONS_BY_STAGE, {"game_id": game_id, "stage_id": stage_id})
+        .scalars()
+        .all()
+    )
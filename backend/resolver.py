@@ -126,12 +126,17 @@ Step 5
 import logging
 from enum import Enum
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
-from .model import ActionModel
 from .model import GameStage
 from .model import PlayerModel
+from .model import PlayerRole
 from .model import PlayerState
+from .model import SlimActionModel
 
 if False:  # for typing
     from ..game import WurwolvesGame
@@ -219,6 +224,76 @@ class TeamBehaviour(Enum):
     DUPLICATED_PER_ROLE = 3
 
 
+class ActionAvailabilityContext:
+    """
+    The facts about a game which decide whether actions are available
+
+    Checking whether an action is available is done for every player whenever
+    a game is rendered or an action is submitted, so the role presence and
+    action history of the game are gathered here once and passed to
+    GameAction.is_action_available instead of querying the game each time.
+
+    Build one with WurwolvesGame.get_availability_context.
+    """
+
+    def __init__(self, players: Iterable, actions: Iterable):
+        """
+        Args:
+            players: Players in the game, with id, role and state
+            actions: All actions in the game, with player_id, role, stage,
+                stage_id and expired
+        """
+        self._roles_present: Set[Tuple[PlayerRole, PlayerState]] = {
+            (p.role, p.state) for p in players
+        }
+
+        # player_id -> list of (stage, stage_id, expired)
+        self._player_actions: Dict[int, List[Tuple[GameStage, int, bool]]] = {}
+
+        # stage_id -> roles which have acted in that stage
+        self._roles_acted: Dict[int, Set[PlayerRole]] = {}
+
+        for a in actions:
+            self._player_actions.setdefault(a.player_id, []).append(
+                (a.stage, a.stage_id, a.expired)
+            )
+            self._roles_acted.setdefault(a.stage_id, set()).add(a.role)
+
+    def is_role_present(
+        self, role: Optional[PlayerRole], state: Optional[PlayerState] = None
+    ) -> bool:
+        """
+        Is there at least one player with this role and state in the game?
+        """
+        return any(
+            (role is None or r == role) and (state is None or s == state)
+            for r, s in self._roles_present
+        )
+
+    def player_has_acted(
+        self,
+        player_id: int,
+        stage: GameStage = None,
+        stage_id: int = None,
+        include_expired=False,
+    ) -> bool:
+        """
+        Has this player submitted an action, optionally in the given stage / stage_id?
+        """
+        return any(
+            (stage is None or a_stage == stage)
+            and (stage_id is None or a_stage_id == stage_id)
+            and (include_expired or not expired)
+            for a_stage, a_stage_id, expired in self._player_actions.get(player_id, [])
+        )
+
+    def roles_acted(self, stage_id: int) -> Set[PlayerRole]:
+        """
+        Which roles have submitted actions in this stage_id?
+        """
+        return self._roles_acted.get(stage_id, set())
+
+
 class GameAction(ActionMixin):
     # This is a dict of mixins which affect child classes of this class. There is one entry for each
     # type of interaction, i.e. each ModifierType. Each ModifierType has a dict of child class -> mixins
@@ -252,7 +327,13 @@ class GameAction(ActionMixin):
     priority = 0
 
     @classmethod
-    def is_action_available(cls, game, stage, stage_id, player_id):
+    def is_action_available(
+        cls,
+        context: ActionAvailabilityContext,
+        stage: GameStage,
+        stage_id: int,
+        player_id: int,
+    ):
         """
         Is the action enabled at this stage? Override this function if a role needs to prevent
         other actions from even being submitted.
@@ -262,8 +343,8 @@ class GameAction(ActionMixin):
         logging.debug("Default is_action_available used")
         return True
 
-    def __init__(self, action_model: ActionModel, players: Dict[int, GamePlayer]):
-        self.model: ActionModel = action_model
+    def __init__(self, action_model: SlimActionModel, players: Dict[int, GamePlayer]):
+        self.model: SlimActionModel = action_model
         self.originator: GamePlayer = None
         self.target: GamePlayer = None
         self.prevented = False
@@ -377,9 +458,10 @@ class GameAction(ActionMixin):
 
 
 def game_ended(game):
-    from .roles import team_has_won, win_ends_game, Team, win_action
+    from .roles import team_has_won, win_ends_game, Team, TeamTally, win_action
 
-    wins = [team for team in list(Team) if team_has_won(game, team)]
+    tally = TeamTally.from_game(game)
+    wins = [team for team in list(Team) if team_has_won(tally, team)]
     for winning_team in wins:
         win_action(game, winning_team)
 
@@ -459,7 +541,7 @@ def process_actions(game: "WurwolvesGame", stage: GameStage, stage_id: int) -> N
 
     game_actions = []
     for a in actions:
-        action_class = get_role_action(a.player.role, stage)
+        action_class = get_role_action(game_players[a.player_id].model.role, stage)
         game_actions.append(action_class(a, game_players))
 
     # Sort actions by priority then by action id
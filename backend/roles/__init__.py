@@ -7,9 +7,11 @@ from .registration import get_apparant_role
 from .registration import get_role_action
 from .registration import get_role_description
 from .registration import get_role_team
+from .registration import get_team_roles
 from .registration import register_roles
 from .registration import router
 from .teams import Team
+from .teams import TeamTally
 from .teams import team_has_won
 from .teams import win_action
 from .teams import win_ends_game
@@ -22,6 +24,7 @@ __all__ = [
     "get_role_description",
     "get_apparant_role",
     "get_role_team",
+    "get_team_roles",
     "do_startup_callback",
     "RANDOMISED_ROLES",
     "register_roles",
@@ -29,5 +32,6 @@ __all__ = [
     "team_has_won",
     "win_ends_game",
     "Team",
+    "TeamTally",
     "win_action",
 ]
@@ -43,6 +43,9 @@ class StageAction(pydantic.BaseModel):
 
         return v
 
+    class Config:
+        frozen = True
+
 
 class RoleDescription(pydantic.BaseModel):
     display_name: str
@@ -89,30 +92,55 @@ class RoleDescription(pydantic.BaseModel):
 
         return v
 
-    def get_stage_action(self, stage: GameStage) -> StageAction:
+    # StageActions for each stage, resolved against the fallback role when the
+    # description is built. These are shared between callers so mustn't be changed.
+    _stage_actions: Dict[GameStage, StageAction] = pydantic.PrivateAttr(
+        default_factory=dict
+    )
+
+    def model_post_init(self, __context) -> None:
+        for stage in list(GameStage):
+            stage_action = self._resolve_stage_action(stage)
+            if stage_action is not None:
+                self._stage_actions[stage] = stage_action
+
+    def _resolve_stage_action(self, stage: GameStage) -> Optional[StageAction]:
         """Get the StageAction for this stage, getting values from the role or fallback role as required.
 
         To do this, first get the main StageAction. If there isn't one, get the fallback StageAction. If
         there is one but there's no button text, get the button text from the fallback role if there is any.
         """
         if stage in self.stages:
-            stage_action = self.stages[stage].copy()
+            stage_action = self.stages[stage]
             if not stage_action.button_text and self.fallback_role_description:
                 fallback_desc = self.fallback_role_description.get_stage_action(stage)
 
-                stage_action.button_text = fallback_desc.button_text
-                stage_action.select_person = fallback_desc.select_person
+                stage_action = stage_action.model_copy(
+                    update={
+                        "button_text": fallback_desc.button_text,
+                        "select_person": fallback_desc.select_person,
+                    }
+                )
+            return stage_action
         elif self.fallback_role_description:
-            stage_action = self.fallback_role_description.get_stage_action(stage)
+            return self.fallback_role_description.get_stage_action(stage)
         else:
-            raise KeyError(f"Stage {stage} not present and fallback not provided")
+            return None
+
+    def get_stage_action(self, stage: GameStage) -> StageAction:
+        """Get the resolved StageAction for this stage
 
-        return stage_action
+        The returned StageAction is frozen and shared by all callers.
+        """
+        try:
+            return self._stage_actions[stage]
+        except KeyError:
+            raise KeyError(f"Stage {stage} not present and fallback not provided")
 
     team: Team
 
     class Config:
-        allow_mutation = False
+        frozen = True
 
 
 RoleDescription.update_forward_refs()
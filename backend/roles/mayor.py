@@ -8,6 +8,7 @@ from typing import TYPE_CHECKING
 from ..model import GameStage
 from ..model import PlayerRole
 from ..model import PlayerState
+from ..resolver import ActionAvailabilityContext
 from ..resolver import ActionMixin
 from ..resolver import GameAction
 from .common import RoleDescription
@@ -69,21 +70,27 @@ class CancelledByMayor(ActionMixin):
 
     @classmethod
     def is_action_available(
-        cls, game: "WurwolvesGame", stage: GameStage, stage_id: int, player_id: int
+        cls,
+        context: ActionAvailabilityContext,
+        stage: GameStage,
+        stage_id: int,
+        player_id: int,
     ):
         """
         Check if a mayor is present and allow / disallow
         this action accordingly
         """
-        mayor_is_present = game.is_role_present(PlayerRole.MAYOR, PlayerState.ALIVE)
+        mayor_is_present = context.is_role_present(PlayerRole.MAYOR, PlayerState.ALIVE)
         logging.debug(
-            f"In mayor is_action_available, game.is_role_present(PlayerRole.MAYOR) = {mayor_is_present}"
+            f"In mayor is_action_available, context.is_role_present(PlayerRole.MAYOR) = {mayor_is_present}"
         )
 
         out = not mayor_is_present
 
         if hasattr(super(), "is_action_available"):
-            out = out and super().is_action_available(game, stage, stage_id, player_id)
+            out = out and super().is_action_available(
+                context, stage, stage_id, player_id
+            )
 
         return out
 
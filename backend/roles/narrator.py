@@ -8,6 +8,7 @@ from typing import TYPE_CHECKING
 from ..model import GameStage
 from ..model import PlayerRole
 from ..model import PlayerState
+from ..resolver import ActionAvailabilityContext
 from ..resolver import ActionMixin
 from ..resolver import GameAction
 from .common import RoleDescription
@@ -79,21 +80,27 @@ class CancelledByNarrator(ActionMixin):
 
     @classmethod
     def is_action_available(
-        cls, game: "WurwolvesGame", stage: GameStage, stage_id: int, player_id: int
+        cls,
+        context: ActionAvailabilityContext,
+        stage: GameStage,
+        stage_id: int,
+        player_id: int,
     ):
         """
         Check if a narrator is present and allow / disallow
         the villagers from voting accordingly
         """
-        narrator_is_present = game.is_role_present(PlayerRole.NARRATOR)
+        narrator_is_present = context.is_role_present(PlayerRole.NARRATOR)
         logging.info(
-            f"In narrator is_action_available, game.is_role_present(PlayerRole.NARRATOR) = {narrator_is_present}"
+            f"In narrator is_action_available, context.is_role_present(PlayerRole.NARRATOR) = {narrator_is_present}"
         )
 
         out = not narrator_is_present
 
         if hasattr(super(), "is_action_available"):
-            out = out and super().is_action_available(game, stage, stage_id, player_id)
+            out = out and super().is_action_available(
+                context, stage, stage_id, player_id
+            )
 
         return out
 
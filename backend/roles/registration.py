@@ -1,9 +1,13 @@
 import logging
 from functools import partial
+from types import MappingProxyType
 from typing import Callable
 from typing import Dict
+from typing import FrozenSet
+from typing import Mapping
 from typing import Optional
 from typing import Tuple
+from typing import Type
 from typing import TYPE_CHECKING
 from typing import Union
 from uuid import UUID
@@ -39,6 +43,7 @@ from .common import RoleDetails
 
 if TYPE_CHECKING:
     from ..resolver import GameAction
+    from .teams import Team
 
 router = APIRouter()
 
@@ -73,27 +78,82 @@ for r in list(PlayerRole):
 registered_with_game = []
 
 
-def get_apparant_role(
-    role: PlayerRole, stage: GameStage
-) -> Tuple[PlayerRole, RoleDescription]:
-    desc = get_role_description(role)
+def _resolve_role_description(role: PlayerRole) -> RoleDescription:
+    desc = ROLE_MAP[role].role_description
+    if callable(desc):
+        desc = desc()
+
+    return desc
+
+
+def _resolve_role_action(role: PlayerRole, stage: GameStage):
+    role_description = _resolve_role_description(role)
+    role_actions = ROLE_MAP[role].actions
+
+    action_class = None
+    if role_actions and stage in role_actions:
+        action_class = role_actions[stage]
+    elif role_description.fallback_role:
+        action_class = _resolve_role_action(role_description.fallback_role, stage)
+
+    return action_class
+
+
+def _resolve_apparant_role(role: PlayerRole, stage: GameStage) -> PlayerRole:
+    desc = _resolve_role_description(role)
 
     if stage in desc.masked_role_in_stages:
         role = desc.masked_role_in_stages[stage]
-        desc = get_role_description(role)
 
-    return role, desc
+    return role
+
+
+# Lookup tables built from ROLE_MAP, so that the functions below, which are
+# called in tight loops, are just dictionary lookups
+ROLE_DESCRIPTIONS: Mapping[PlayerRole, RoleDescription] = MappingProxyType(
+    {role: _resolve_role_description(role) for role in PlayerRole}
+)
+ROLE_TEAMS: Mapping[PlayerRole, "Team"] = MappingProxyType(
+    {role: desc.team for role, desc in ROLE_DESCRIPTIONS.items()}
+)
+TEAM_ROLES: Mapping["Team", FrozenSet[PlayerRole]] = MappingProxyType(
+    {
+        team: frozenset(role for role in PlayerRole if ROLE_TEAMS[role] == team)
+        for team in set(ROLE_TEAMS.values())
+    }
+)
+# (role, stage) -> action class, for roles which have an action in that stage
+ROLE_ACTIONS: Mapping[Tuple[PlayerRole, GameStage], Type["GameAction"]] = (
+    MappingProxyType(
+        {
+            (role, stage): _resolve_role_action(role, stage)
+            for role in PlayerRole
+            for stage in GameStage
+            if _resolve_role_action(role, stage)
+        }
+    )
+)
+APPARANT_ROLES: Mapping[Tuple[PlayerRole, GameStage], PlayerRole] = MappingProxyType(
+    {
+        (role, stage): _resolve_apparant_role(role, stage)
+        for role in PlayerRole
+        for stage in GameStage
+    }
+)
+
+
+def get_apparant_role(
+    role: PlayerRole, stage: GameStage
+) -> Tuple[PlayerRole, RoleDescription]:
+    role = APPARANT_ROLES[(role, stage)]
+    return role, ROLE_DESCRIPTIONS[role]
 
 
 def get_role_description(role) -> RoleDescription:
     """
     Get the RoleDescription for this role
     """
-    desc = ROLE_MAP[role].role_description
-    if callable(desc):
-        desc = desc()
-
-    return desc
+    return ROLE_DESCRIPTIONS[role]
 
 
 def get_action_func_name(role: PlayerRole, stage: GameStage):
@@ -101,7 +161,12 @@ def get_action_func_name(role: PlayerRole, stage: GameStage):
 
 
 def get_role_team(role: PlayerRole):
-    return get_role_description(role).team
+    return ROLE_TEAMS[role]
+
+
+def get_team_roles(team) -> FrozenSet[PlayerRole]:
+    """Get all the roles in a team"""
+    return TEAM_ROLES.get(team, frozenset())
 
 
 def get_role_actions(role: PlayerRole):
@@ -114,16 +179,7 @@ def get_role_callback(role: PlayerRole) -> Union[Callable, None]:
 
 def get_role_action(role: PlayerRole, stage: GameStage) -> Union[None, "GameAction"]:
     """Get the action class associated with a role and stage, or None"""
-    role_description = get_role_description(role)
-    role_actions = get_role_actions(role)
-
-    action_class = None
-    if role_actions and stage in role_actions:
-        action_class = role_actions[stage]
-    elif role_description.fallback_role:
-        action_class = get_role_action(role_description.fallback_role, stage)
-
-    return action_class
+    return ROLE_ACTIONS.get((role, stage))
 
 
 def do_startup_callback(game, role: PlayerRole) -> None:
@@ -314,6 +370,13 @@ def register_role(WurwolvesGame, role: PlayerRole):
                 ):
                     raise HTTPException(400, "You must select a target")
 
+                # Strings are valid for the Union so aren't coerced by FastAPI
+                if isinstance(selected_id, str):
+                    try:
+                        selected_id = UUID(selected_id)
+                    except ValueError:
+                        raise HTTPException(400, "Invalid target")
+
                 g = WurwolvesGame(game_tag)
                 f = getattr(WurwolvesGame, func_name)
                 f(g, user_id, selected_id)
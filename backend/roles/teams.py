@@ -1,5 +1,7 @@
 import logging
+from collections import Counter
 from enum import Enum
+from typing import Iterable
 from typing import TYPE_CHECKING
 
 from ..model import PlayerRole
@@ -17,36 +19,45 @@ class Team(Enum):
     NARRATOR = "narrator"
 
 
-def villagers_won(game):
-    num_alive_wolves = number_of(game, Team.WOLVES, PlayerState.ALIVE)
+class TeamTally:
+    """
+    Number of players in each team and state, counted in a single pass
 
-    return num_alive_wolves == 0
+    Build one with `TeamTally.from_game` and pass it to all the functions in
+    `win_map`, so that judging a stage only needs to look at each player once.
+    """
 
+    def __init__(self, players: Iterable):
+        from .registration import get_role_team
 
-def wolves_won(game):
-    num_alive_villagers = number_of(game, Team.VILLAGERS, PlayerState.ALIVE)
-    num_alive_jesters = number_of(game, Team.JESTER, PlayerState.ALIVE)
-    num_alive_wolves = number_of(game, Team.WOLVES, PlayerState.ALIVE)
+        self._counts = Counter(
+            (get_role_team(player.role), player.state) for player in players
+        )
 
-    return num_alive_wolves >= num_alive_villagers + num_alive_jesters
+    @classmethod
+    def from_game(cls, game: "WurwolvesGame") -> "TeamTally":
+        return cls(game.get_players())
 
+    def number_of(self, team: Team, state: PlayerState) -> int:
+        return self._counts[(team, state)]
 
-def number_of(game, team: Team, state: PlayerState):
-    from .registration import get_role_team
 
-    num = 0
+def villagers_won(tally: TeamTally):
+    num_alive_wolves = tally.number_of(Team.WOLVES, PlayerState.ALIVE)
+
+    return num_alive_wolves == 0
 
-    players = game.get_players_model()
-    for player in players:
-        player_team = get_role_team(player.role)
-        if player_team == team and player.state == state:
-            num += 1
 
-    return num
+def wolves_won(tally: TeamTally):
+    num_alive_villagers = tally.number_of(Team.VILLAGERS, PlayerState.ALIVE)
+    num_alive_jesters = tally.number_of(Team.JESTER, PlayerState.ALIVE)
+    num_alive_wolves = tally.number_of(Team.WOLVES, PlayerState.ALIVE)
+
+    return num_alive_wolves >= num_alive_villagers + num_alive_jesters
 
 
-def jester_won(game):
-    num_lynched_jester = number_of(game, Team.JESTER, PlayerState.LYNCHED)
+def jester_won(tally: TeamTally):
+    num_lynched_jester = tally.number_of(Team.JESTER, PlayerState.LYNCHED)
 
     return bool(num_lynched_jester)
 
@@ -63,8 +74,8 @@ if any(team not in win_map for team in list(Team)):
     raise TypeError("Not all teams are in the win_map")
 
 
-def team_has_won(game: "WurwolvesGame", team: Team) -> bool:
-    return win_map[team](game)
+def team_has_won(tally: TeamTally, team: Team) -> bool:
+    return win_map[team](tally)
 
 
 def win_ends_game(team: Team) -> bool:
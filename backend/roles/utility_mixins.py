@@ -4,6 +4,7 @@ from fastapi import HTTPException
 
 from ..model import GameStage
 from ..model import PlayerState
+from ..resolver import ActionAvailabilityContext
 from ..resolver import ActionMixin
 from ..resolver import GameAction
 
@@ -14,19 +15,21 @@ if TYPE_CHECKING:
 class OncePerGame(GameAction):
     @classmethod
     def is_action_available(
-        cls, game: "WurwolvesGame", stage: GameStage, stage_id: int, player_id: int
+        cls,
+        context: ActionAvailabilityContext,
+        stage: GameStage,
+        stage_id: int,
+        player_id: int,
     ):
         """
         Disallow the action if it's already been done this game
         """
-        previous_actions = game.get_actions_model(
-            player_id=player_id, stage=GameStage.NIGHT
-        )
-
-        out = not bool(previous_actions)
+        out = not context.player_has_acted(player_id, stage=GameStage.NIGHT)
 
         if hasattr(super(), "is_action_available"):
-            out = out and super().is_action_available(game, stage, stage_id, player_id)
+            out = out and super().is_action_available(
+                context, stage, stage_id, player_id
+            )
 
         return out
 
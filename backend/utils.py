@@ -1,4 +1,10 @@
 import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Hashable
+from typing import List
 
 
 def hash_str_to_int(text: str, N: int = 3):
@@ -13,3 +19,131 @@ def hash_str_to_int(text: str, N: int = 3):
 
     # Slice off the first N bytes and cast to integer
     return int.from_bytes(hash_bytes[0:N], "big")
+
+
+class LRUCache:
+    """A thread-safe cache holding at most max_size entries
+
+    When full, the least recently used entry is discarded. Entries also expire
+    ttl seconds after they were stored.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                stored_at, value = self._data[key]
+            except KeyError:
+                return default
+
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def make_json_patch(old: Any, new: Any, path: str = "") -> List[dict]:
+    """Make a JSON patch (RFC 6902) which turns the JSON value old into new
+
+    Only "add", "remove" and "replace" operations are used. Lists are compared
+    element by element, so appending to a list gives a small patch but
+    inserting at the start doesn't.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape_key(key)}"})
+        for key, value in new.items():
+            key_path = f"{path}/{_escape_key(key)}"
+            if key in old:
+                ops.extend(make_json_patch(old[key], value, key_path))
+            else:
+                ops.append({"op": "add", "path": key_path, "value": value})
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(make_json_patch(old[i], new[i], f"{path}/{i}"))
+        # Remove from the end so that the indices stay valid
+        for i in reversed(range(common, len(old))):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+        for value in new[common:]:
+            ops.append({"op": "add", "path": f"{path}/-", "value": value})
+        return ops
+
+    # Check the type too, since e.g. True == 1
+    if type(old) is type(new) and old == new:
+        return []
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def apply_json_patch(doc: Any, patch: List[dict]) -> Any:
+    """Apply a JSON patch made by make_json_patch to doc, which is modified
+
+    Returns the patched document
+    """
+    for op in patch:
+        if not op["path"]:
+            doc = op["value"]
+            continue
+
+        *parents, last = [_unescape_key(k) for k in op["path"].split("/")[1:]]
+
+        target = doc
+        for key in parents:
+            target = target[int(key) if isinstance(target, list) else key]
+
+        if isinstance(target, list):
+            if op["op"] == "add" and last == "-":
+                target.append(op["value"])
+            elif op["op"] == "add":
+                target.insert(int(last), op["value"])
+            elif op["op"] == "remove":
+                del target[int(last)]
+            else:
+                target[int(last)] = op["value"]
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = op["value"]
+
+    return doc
+
+
+def _escape_key(key: str) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape_key(key: str) -> str:
+    return key.replace("~1", "/").replace("~0", "~")
@@ -1,12 +1,62 @@
 import { createStore, combineReducers } from "redux";
 import { createSlice } from "@reduxjs/toolkit";
 
+/**
+ * States fetched with a chat cursor only contain the new chat messages: add
+ * them to the ones we already have, dropping any which have been cleared
+ */
+function mergeChat(oldChat, newState) {
+  if (newState.chatSince === null || newState.chatSince === undefined) {
+    return newState;
+  }
+
+  const kept = oldChat.filter(
+    (m) => m.id >= newState.chatStart && m.id <= newState.chatSince,
+  );
+  return { ...newState, chat: kept.concat(newState.chat), chatSince: null };
+}
+
+/**
+ * Apply a JSON patch, as sent in a FrontendStateDelta, to the state in place
+ */
+function applyPatch(state, patch) {
+  for (const op of patch) {
+    const keys = op.path
+      .split("/")
+      .slice(1)
+      .map((k) => k.replace(/~1/g, "/").replace(/~0/g, "~"));
+    const last = keys.pop();
+
+    let target = state;
+    for (const key of keys) {
+      target = target[key];
+    }
+
+    if (Array.isArray(target)) {
+      if (op.op === "add" && last === "-") {
+        target.push(op.value);
+      } else if (op.op === "add") {
+        target.splice(Number(last), 0, op.value);
+      } else if (op.op === "remove") {
+        target.splice(Number(last), 1);
+      } else {
+        target[Number(last)] = op.value;
+      }
+    } else if (op.op === "remove") {
+      delete target[last];
+    } else {
+      target[last] = op.value;
+    }
+  }
+}
+
 const backend = createSlice({
   name: "backend",
   initialState: {
     state_hash: 0,
     players: [],
     chat: [],
+    chatCursor: null,
     showSecretChat: false,
     stage: "LOBBY",
     controls_state: {},
@@ -16,11 +66,13 @@ const backend = createSlice({
     myStatus: null,
   },
   reducers: {
-    replace: (state, action) => action.payload,
+    replace: (state, action) => mergeChat(state.chat, action.payload),
+    patch: (state, action) => applyPatch(state, action.payload),
   },
 });
 
 export const replaceState = backend.actions.replace;
+export const patchState = backend.actions.patch;
 
 const selectedPlayer = createSlice({
   name: "selectedPlayer",
@@ -44,13 +44,13 @@ export function Chatbox(props) {
       <div className="card card-body d-flex flex-column chat-holder bg-night-black">
         <h5 className="card-title">Events</h5>
         <ScrollableFeed className="chat-box flex-grow-1">
-          {chat_messages.map((m, ind) =>
+          {chat_messages.map((m) =>
             m.isStrong ? (
-              <strong key={ind}>
+              <strong key={m.id}>
                 <ChatEntry msg={m.msg} />
               </strong>
             ) : (
-              <ChatEntry key={ind} msg={m.msg} />
+              <ChatEntry key={m.id} msg={m.msg} />
             ),
           )}
         </ScrollableFeed>
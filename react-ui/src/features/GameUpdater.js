@@ -1,22 +1,30 @@
 /**
  * Game state updater
  *
- * This is a renderless react component which polls the game state for updates
- * at a regular interval. If it gets any updates from the server, it parses them
- * and updates the local state accordingly.
+ * This is a renderless react component which keeps the game state up to date.
+ * If the browser supports it, the state is streamed from the server as
+ * Server-Sent Events. Otherwise (or if the stream fails) it polls the game state
+ * for updates at a regular interval. If it gets any updates from the server, it
+ * parses them and updates the local state accordingly.
  */
 
 import { Component } from "react";
 import { connect } from "react-redux";
-import { replaceState } from "../app/store";
+import { patchState, replaceState } from "../app/store";
 import { make_api_url } from "../utils";
-import { selectAllPlayers, selectMyID, selectStateHash } from "./selectors";
+import {
+  selectAllPlayers,
+  selectChatCursor,
+  selectMyID,
+  selectStateHash,
+} from "./selectors";
 
 class GameUpdater extends Component {
   constructor() {
     super();
 
     this.timeoutID = null;
+    this.eventSource = null;
     this.cancelled = false;
     this.checkAndReschedule = this.checkAndReschedule.bind(this);
     this.joinGame = this.joinGame.bind(this);
@@ -31,8 +39,38 @@ class GameUpdater extends Component {
   }
 
   startPolling() {
-    this.joinGame();
-    this.checkAndReschedule();
+    if (window.EventSource) {
+      this.joinGame().then(() => this.startStream(), this.checkAndReschedule);
+    } else {
+      this.joinGame();
+      this.checkAndReschedule();
+    }
+  }
+
+  startStream() {
+    if (this.cancelled) {
+      return;
+    }
+
+    this.eventSource = new EventSource(
+      make_api_url(this.props.game_tag, "state_stream"),
+    );
+
+    this.eventSource.addEventListener("state", (e) => {
+      const { dispatch } = this.props;
+      dispatch(replaceState(JSON.parse(e.data)));
+    });
+
+    // If the stream fails for any reason, fall back to polling
+    this.eventSource.onerror = () => {
+      console.log(`State stream failed for ${this.props.game_tag}: polling`);
+      this.eventSource.close();
+      this.eventSource = null;
+
+      if (!this.cancelled) {
+        this.checkAndReschedule();
+      }
+    };
   }
 
   checkAndReschedule() {
@@ -91,28 +129,59 @@ class GameUpdater extends Component {
       `Unmounting updater for ${this.props.game_tag} with id ${this.timeoutID}`,
     );
     clearTimeout(this.timeoutID);
+    if (this.eventSource) {
+      this.eventSource.close();
+    }
     this.cancelled = true;
   }
 
-  updateState() {
-    fetch(make_api_url(this.props.game_tag, "state"))
+  updateState(allowDelta = true) {
+    // Only fetch what's changed since our current state, if the server
+    // still knows it. Otherwise, only fetch chat messages we don't have
+    const params = {};
+    if (allowDelta && this.props.state_hash) {
+      params.since_hash = this.props.state_hash;
+    }
+    if (this.props.chat_cursor !== null) {
+      params.chat_since = this.props.chat_cursor;
+    }
+
+    // Skip the download if our state is already current
+    const headers = {};
+    if (this.props.state_hash && this.props.myID) {
+      headers["If-None-Match"] = `"${this.props.state_hash}-${this.props.myID}"`;
+    }
+
+    fetch(make_api_url(this.props.game_tag, "state", params), { headers })
       .then((r) => {
+        if (r.status === 304) {
+          return null;
+        }
         if (!r.ok) {
           throw Error("Fetch state failed with error " + r.status);
         }
         return r.json();
       })
       .then((data) => {
-        if (data) {
-          const { dispatch } = this.props;
+        if (!data) {
+          return;
+        }
+
+        const { dispatch } = this.props;
+        if (data.patch === undefined) {
           dispatch(replaceState(data));
+        } else if (data.base_hash === this.props.state_hash) {
+          dispatch(patchState(data.patch));
+        } else {
+          // Our state changed while the request was in flight
+          this.updateState(false);
         }
       });
   }
 
   joinGame() {
     console.log("Joining game " + this.props.game_tag);
-    fetch(make_api_url(this.props.game_tag, "join"), { method: "post" });
+    return fetch(make_api_url(this.props.game_tag, "join"), { method: "post" });
   }
 
   render() {
@@ -124,7 +193,8 @@ function mapStateToProps(state) {
   const players = selectAllPlayers(state);
   const myID = selectMyID(state);
   const state_hash = selectStateHash(state);
-  return { players, myID, state_hash };
+  const chat_cursor = selectChatCursor(state);
+  return { players, myID, state_hash, chat_cursor };
 }
 
 export default connect(mapStateToProps)(GameUpdater);
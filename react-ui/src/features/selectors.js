@@ -1,4 +1,5 @@
 export const selectMessages = (state) => state.backend.chat;
+export const selectChatCursor = (state) => state.backend.chatCursor;
 
 export const selectStage = (state) => state.backend.stage;
 
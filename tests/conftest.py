@@ -13,6 +13,18 @@ def pytest_addoption(parser):
     parser.addoption(
         "--runselenium", action="store_true", default=False, help="run slow tests"
     )
+    parser.addoption(
+        "--runbenchmark",
+        action="store_true",
+        default=False,
+        help="run the benchmark suite",
+    )
+    parser.addoption(
+        "--benchmark-save",
+        action="store_true",
+        default=False,
+        help="save benchmark results as the new baseline",
+    )
 
 
 def pytest_configure(config):
@@ -20,13 +32,17 @@ def pytest_configure(config):
         "markers",
         "selenium: marks tests as requiring selenium (select with '-m selenium')",
     )
+    config.addinivalue_line(
+        "markers",
+        "benchmark: marks tests as benchmarks (select with '-m benchmark')",
+    )
 
 
 def pytest_collection_modifyitems(config, items):
-    if config.getoption("--runselenium"):
-        # --runslow given in cli: do not skip slow tests
-        return
     skip_selenium = pytest.mark.skip(reason="need --runselenium option to run")
+    skip_benchmark = pytest.mark.skip(reason="need --runbenchmark option to run")
     for item in items:
-        if "selenium" in item.keywords:
+        if "selenium" in item.keywords and not config.getoption("--runselenium"):
             item.add_marker(skip_selenium)
+        if "benchmark" in item.keywords and not config.getoption("--runbenchmark"):
+            item.add_marker(skip_benchmark)
@@ -171,10 +171,19 @@ def db_session(engine):
     """
     from backend.model import Base
     from backend.database import Session
+    from backend.game import rendered_state_cache
+    from backend.game import snapshot_cache
+    from backend.presence import store as presence_store
     import random
 
     random.seed(123)
 
+    # Games and their update tags are reproducible, so don't let cached
+    # snapshots, rendered states or player presence leak between tests
+    snapshot_cache.clear()
+    rendered_state_cache.clear()
+    presence_store.clear()
+
     Base.metadata.bind = engine
 
     Base.metadata.drop_all()
@@ -300,3 +300,58 @@ def test_action_preventable(demo_game):
     ):
         with pytest.raises(HTTPException):
             do_medic()
+
+
+def test_availability_context():
+    from backend.resolver import ActionAvailabilityContext
+
+    players = [
+        Mock(id=1, role=PlayerRole.WOLF, state=PlayerState.ALIVE),
+        Mock(id=2, role=PlayerRole.MAYOR, state=PlayerState.LYNCHED),
+    ]
+    actions = [
+        Mock(
+            player_id=1,
+            role=PlayerRole.WOLF,
+            stage=GameStage.NIGHT,
+            stage_id=3,
+            expired=False,
+        ),
+        Mock(
+            player_id=2,
+            role=PlayerRole.MAYOR,
+            stage=GameStage.DAY,
+            stage_id=4,
+            expired=True,
+        ),
+    ]
+
+    context = ActionAvailabilityContext(players, actions)
+
+    assert context.is_role_present(PlayerRole.WOLF)
+    assert context.is_role_present(PlayerRole.MAYOR)
+    assert not context.is_role_present(PlayerRole.MAYOR, PlayerState.ALIVE)
+    assert not context.is_role_present(PlayerRole.SEER)
+
+    assert context.player_has_acted(1, stage=GameStage.NIGHT)
+    assert not context.player_has_acted(1, stage_id=4)
+    assert not context.player_has_acted(2)
+    assert context.player_has_acted(2, stage_id=4, include_expired=True)
+
+    assert context.roles_acted(3) == {PlayerRole.WOLF}
+    assert context.roles_acted(5) == set()
+
+
+def test_availability_context_queried_once(demo_game):
+    demo_game.start_game()
+
+    with patch.object(
+        WurwolvesGame,
+        "get_availability_context",
+        autospec=True,
+        side_effect=WurwolvesGame.get_availability_context,
+    ) as mock_context, patch.object(WurwolvesGame, "get_actions_model") as mock_actions:
+        WurwolvesGame(GAME_ID).parse_game_to_state(USER_ID)
+
+    mock_context.assert_called_once()
+    mock_actions.assert_not_called()
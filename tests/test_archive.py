@@ -0,0 +1,135 @@
+from uuid import uuid4 as uuid
+
+import pytest
+
+from backend import archive
+from backend.game import WurwolvesGame
+from backend.model import Action
+from backend.model import ArchivedAction
+from backend.model import ArchivedMessage
+from backend.model import GameStage
+from backend.model import Message
+from backend.model import PlayerRole
+
+GAME_ID = "hot-potato"
+
+
+@pytest.fixture
+def game(db_session) -> WurwolvesGame:
+    g = WurwolvesGame(GAME_ID)
+    for _ in range(3):
+        g.join(uuid())
+    return g
+
+
+def _medic_acts(game):
+    medic = game.get_players_model()[0]
+    game.set_player_role(medic.id, PlayerRole.MEDIC)
+    game.medic_night_action(medic.user.id, medic.user.id)
+
+
+def test_new_game_archives_previous(game, db_session):
+    game.start_game()
+    _medic_acts(game)
+    game.send_chat_message("From the first game")
+
+    first_messages = {m.id for m in db_session.query(Message)}
+    first_actions = {a.id for a in db_session.query(Action)}
+    assert first_actions
+
+    game.start_game()
+    db_session.expire_all()
+
+    assert first_messages <= {m.id for m in db_session.query(ArchivedMessage)}
+    assert {a.id for a in db_session.query(ArchivedAction)} == first_actions
+
+    # Only the new game's rows are still live
+    assert db_session.query(Action).count() == 0
+    assert not first_messages & {m.id for m in db_session.query(Message)}
+    assert "From the first game" not in [
+        m.text for m in game.get_messages(uuid(), include_expired=True)
+    ]
+
+    archived = (
+        db_session.query(ArchivedMessage)
+        .filter(ArchivedMessage.text == "From the first game")
+        .one()
+    )
+    assert archived.game_id == game.game_id
+    assert archived.time_archived is not None
+
+
+def test_ids_not_reused(game, db_session):
+    game.send_chat_message("Last before clearing")
+    last_id = game.get_game_model().messages[-1].id
+
+    game.clear_chat_messages()
+    assert game.get_snapshot().chat_cursor == last_id
+
+    game.send_chat_message("First after clearing")
+    assert game.get_game_model().messages[-1].id > last_id
+
+
+def test_archive_all(game, db_session):
+    other_game = WurwolvesGame(f"{GAME_ID}-other")
+    other_game.join(uuid())
+
+    player_ids = [game.get_players()[0].id, other_game.get_players()[0].id]
+    for g, player_id in zip([game, other_game], player_ids):
+        for expired in [True, False]:
+            db_session.add(
+                Action(
+                    game_id=g.game_id,
+                    player_id=player_id,
+                    stage_id=1,
+                    stage=GameStage.NIGHT,
+                    role=PlayerRole.MEDIC,
+                    expired=expired,
+                )
+            )
+            db_session.add(Message(game_id=g.game_id, text="Hi", expired=expired))
+    db_session.commit()
+
+    archive.archive_all()
+
+    db_session.expire_all()
+    assert db_session.query(ArchivedAction).count() == 2
+    assert db_session.query(ArchivedMessage).count() == 2
+    assert db_session.query(Action).filter(Action.expired == True).count() == 0
+    assert db_session.query(Message).filter(Message.expired == True).count() == 0
+    assert db_session.query(Action).count() == 2
+
+
+def test_ended_game_actions_archived(game, db_session):
+    game.start_game()
+    _medic_acts(game)
+    first_actions = {a.id for a in db_session.query(Action)}
+    assert first_actions
+
+    game.end_game()
+    game.move_to_lobby()
+    game.start_game()
+
+    db_session.expire_all()
+    assert db_session.query(Action).count() == 0
+    assert {a.id for a in db_session.query(ArchivedAction)} == first_actions
+
+
+def test_archive_all_orphans(game, db_session):
+    db_session.add(
+        Action(
+            game_id=None,
+            player_id=game.get_players()[0].id,
+            stage_id=1,
+            stage=GameStage.NIGHT,
+            role=PlayerRole.MEDIC,
+            expired=False,
+        )
+    )
+    db_session.commit()
+
+    archive.archive_all()
+
+    db_session.expire_all()
+    assert db_session.query(Action).count() == 0
+    assert db_session.query(ArchivedAction).one().game_id is None
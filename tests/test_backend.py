@@ -239,3 +239,162 @@ def test_end_game(api_client, db_session):
         assert r.status_code == 200
 
         assert g.get_game_model().stage == GameStage.ENDED
+
+
+def test_state_stream(db_session):
+    import asyncio
+    from uuid import uuid4 as uuid
+
+    from backend.main import state_events
+
+    user_id = uuid()
+    g = WurwolvesGame(GAME_ID)
+    g.join(user_id)
+
+    async def never_disconnected():
+        return False
+
+    async def tester():
+        events = state_events(GAME_ID, user_id, never_disconnected, timeout=0.2)
+
+        # The current state is sent straight away
+        first = await events.__anext__()
+        assert first.startswith("event: state\ndata: ")
+        assert json.loads(first.split("data: ")[1])["myID"] == str(user_id)
+
+        # Nothing changes, so we just get a keepalive comment
+        assert (await events.__anext__()).startswith(":")
+
+        # A change pushes a new state without any polling
+        next_event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.05)
+        g.send_chat_message("Hello stream")
+        event = await asyncio.wait_for(next_event, timeout=0.1)
+        assert event.startswith("event: state")
+        assert "Hello stream" in event
+
+        await events.aclose()
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+
+def test_get_chat(api_client, db_session):
+    api_client.post(f"/api/{GAME_ID}/join")
+    g = WurwolvesGame(GAME_ID)
+
+    chat = api_client.get(f"/api/{GAME_ID}/chat").json()
+    assert "New game created" in chat["chat"][0]["msg"]
+
+    g.send_chat_message("Hello")
+
+    update = api_client.get(
+        f"/api/{GAME_ID}/chat", params={"since": chat["chatCursor"]}
+    ).json()
+    assert [m["msg"] for m in update["chat"]] == ["Hello"]
+    assert update["chatCursor"] > chat["chatCursor"]
+
+    state = api_client.get(
+        f"/api/{GAME_ID}/state", params={"chat_since": update["chatCursor"]}
+    ).json()
+    assert state["chat"] == []
+    assert state["chatCursor"] == update["chatCursor"]
+
+
+def test_state_delta(api_client, db_session):
+    from backend.utils import apply_json_patch
+
+    api_client.post(f"/api/{GAME_ID}/join")
+    state = api_client.get(f"/api/{GAME_ID}/state").json()
+
+    g = WurwolvesGame(GAME_ID)
+    g.send_chat_message("Hello")
+
+    delta = api_client.get(
+        f"/api/{GAME_ID}/state", params={"since_hash": state["state_hash"]}
+    ).json()
+
+    assert delta["base_hash"] == state["state_hash"]
+    assert delta["state_hash"] != state["state_hash"]
+    assert len(delta["patch"]) < 5
+
+    full_state = api_client.get(f"/api/{GAME_ID}/state").json()
+    assert apply_json_patch(state, delta["patch"]) == full_state
+
+
+def test_state_delta_unknown_base(api_client, db_session):
+    api_client.post(f"/api/{GAME_ID}/join")
+
+    state = api_client.get(f"/api/{GAME_ID}/state", params={"since_hash": 123}).json()
+    assert "patch" not in state
+    assert state["players"]
+
+
+def test_state_etag(api_client, db_session):
+    from unittest.mock import patch
+
+    api_client.post(f"/api/{GAME_ID}/join")
+    r = api_client.get(f"/api/{GAME_ID}/state")
+    etag = r.headers["ETag"]
+
+    assert str(r.json()["state_hash"]) in etag
+    assert str(r.json()["myID"]) in etag
+
+    # Nothing changed, so the state isn't rendered
+    with patch.object(WurwolvesGame, "get_state_update") as get_state_update:
+        r = api_client.get(f"/api/{GAME_ID}/state", headers={"If-None-Match": etag})
+        get_state_update.assert_not_called()
+
+    assert r.status_code == 304
+    assert r.headers["ETag"] == etag
+    assert not r.content
+
+    WurwolvesGame(GAME_ID).send_chat_message("Hello")
+
+    r = api_client.get(f"/api/{GAME_ID}/state", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+
+def test_state_etag_wildcard(api_client, db_session):
+    # The game doesn't exist yet, so there's no state the client could have
+    r = api_client.get(f"/api/{GAME_ID}/state", headers={"If-None-Match": "*"})
+    assert r.status_code != 304
+    assert r.content
+
+
+def test_get_chat_not_registered(api_client, db_session):
+    WurwolvesGame(GAME_ID).create_game()
+    assert api_client.get(f"/api/{GAME_ID}/chat").status_code == 404
+
+
+def test_state_stream_not_registered(api_client):
+    response = api_client.get(f"/api/{GAME_ID}/state_stream")
+    assert response.status_code == 404
+
+
+def test_action_with_target(api_client, db_session):
+    from uuid import UUID
+    from uuid import uuid4 as uuid
+
+    g = WurwolvesGame(GAME_ID)
+
+    with api_client as s:
+        s.post(f"/api/{GAME_ID}/join")
+        my_id = UUID(s.get("/api/my_id").json())
+
+        target_id = uuid()
+        for u in [target_id, uuid(), uuid()]:
+            g.join(u)
+
+        g.start_game()
+        g.set_player_role(g.get_player_id(my_id), PlayerRole.SEER)
+
+        r = s.post(
+            f"/api/{GAME_ID}/seer_night_action", params={"selected_id": str(target_id)}
+        )
+        assert r.status_code == 200
+
+        r = s.post(
+            f"/api/{GAME_ID}/seer_night_action", params={"selected_id": "not-a-uuid"}
+        )
+        assert r.status_code == 400
@@ -0,0 +1,410 @@
+"""
+Benchmarks for full game lifecycles
+
+These simulate K games of N players, each played from the lobby through to the
+end of the game, and record the latency, database queries and ORM rows loaded
+by every request. Games are interleaved so that the database holds K games at
+once, as it would in production.
+
+Run with::
+
+    pytest --runbenchmark -m benchmark
+
+Results are compared against the baseline in benchmark_baseline.json: query
+and row counts are deterministic, so any increase is reported as a failure.
+Latencies depend on the machine and are recorded for information only. Pass
+--benchmark-save to overwrite the baseline with the latest results.
+
+By default the benchmarks run against the SQLite testing database. Set
+BENCHMARK_POSTGRES_URL to a Postgres database to also run them there. The
+size of the simulation can be set with BENCHMARK_GAMES and BENCHMARK_PLAYERS.
+
+There is also a micro-benchmark of rendering and serialising a single
+FrontendState, which logs the time per render.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from uuid import UUID
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from backend.game import WurwolvesGame
+from backend.model import GameStage
+from backend.model import PlayerState
+
+pytestmark = pytest.mark.benchmark
+
+BASELINE_FILE = Path(__file__).parent / "benchmark_baseline.json"
+
+NUM_GAMES = int(os.environ.get("BENCHMARK_GAMES", 4))
+NUM_PLAYERS = int(os.environ.get("BENCHMARK_PLAYERS", 8))
+
+# Give up on games which haven't ended after this many rounds of actions
+MAX_ROUNDS = 50
+
+# Fractional increase in queries or rows per request allowed before failing
+TOLERANCE = 0.1
+
+PERCENTILES = [50, 90, 99]
+
+
+class RequestStats:
+    """Collect latencies, queries and rows loaded, grouped by request type"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.rows = defaultdict(list)
+
+        self._queries = 0
+        self._rows = 0
+
+    def _count_query(self, *args, **kwargs):
+        self._queries += 1
+
+    def _count_row(self, *args, **kwargs):
+        self._rows += 1
+
+    @contextmanager
+    def listening(self, engine):
+        from backend.model import Base
+
+        event.listen(engine, "after_cursor_execute", self._count_query)
+        event.listen(Base, "load", self._count_row, propagate=True)
+        try:
+            yield
+        finally:
+            event.remove(engine, "after_cursor_execute", self._count_query)
+            event.remove(Base, "load", self._count_row)
+
+    @contextmanager
+    def measure(self, name):
+        queries_before = self._queries
+        rows_before = self._rows
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies[name].append(time.perf_counter() - t_start)
+            self.queries[name].append(self._queries - queries_before)
+            self.rows[name].append(self._rows - rows_before)
+
+    def summary(self):
+        out = {}
+        for name in sorted(self.latencies):
+            latencies = sorted(self.latencies[name])
+            out[name] = {
+                "count": len(latencies),
+                "latency_ms": {
+                    f"p{p}": round(1e3 * _percentile(latencies, p), 3)
+                    for p in PERCENTILES
+                },
+                "queries_per_request": round(
+                    sum(self.queries[name]) / len(latencies), 3
+                ),
+                "rows_per_request": round(sum(self.rows[name]) / len(latencies), 3),
+            }
+        return out
+
+
+def _percentile(sorted_values, p):
+    index = round((len(sorted_values) - 1) * p / 100)
+    return sorted_values[index]
+
+
+class DirectDriver:
+    """Play a game by calling WurwolvesGame directly"""
+
+    def __init__(self, game_tag, num_players, stats: RequestStats, rng):
+        self.game_tag = game_tag
+        self.stats = stats
+        self.rng = rng
+        self.users = [UUID(int=rng.getrandbits(128)) for _ in range(num_players)]
+
+        for u in self.users:
+            with self.stats.measure("join"):
+                WurwolvesGame(game_tag).join(u)
+
+    def get_state(self, user_id):
+        with self.stats.measure("state"):
+            return WurwolvesGame(self.game_tag).parse_game_to_state(user_id)
+
+    def act(self, user_id, func_name, selected_id):
+        args = (user_id, selected_id) if selected_id else (user_id,)
+        with self.stats.measure(func_name):
+            try:
+                getattr(WurwolvesGame(self.game_tag), func_name)(*args)
+            except HTTPException:
+                # Invalid choices are part of the game, e.g. saving the same
+                # person twice as the medic
+                pass
+
+
+class APIDriver:
+    """Play a game through the FastAPI app"""
+
+    def __init__(self, game_tag, num_players, stats: RequestStats, rng):
+        from fastapi.testclient import TestClient
+        from backend.main import app
+
+        self.game_tag = game_tag
+        self.stats = stats
+        self.rng = rng
+
+        self.clients = {}
+        for _ in range(num_players):
+            client = TestClient(app)
+            with self.stats.measure("join"):
+                r = client.post(
+                    f"/api/{game_tag}/join", params={"temporary_id": rng.random()}
+                )
+            assert r.status_code == 200
+            user_id = UUID(client.get("/api/my_id").json())
+            self.clients[user_id] = client
+
+        self.users = list(self.clients)
+
+    def get_state(self, user_id):
+        from backend.model import FrontendState
+
+        with self.stats.measure("state"):
+            r = self.clients[user_id].get(f"/api/{self.game_tag}/state")
+        assert r.status_code == 200
+        return FrontendState.parse_obj(r.json())
+
+    def act(self, user_id, func_name, selected_id):
+        params = {"selected_id": str(selected_id)} if selected_id else {}
+        with self.stats.measure(func_name):
+            self.clients[user_id].post(
+                f"/api/{self.game_tag}/{func_name}", params=params
+            )
+
+
+def play_round(driver):
+    """
+    Render the game for every player, then have them all perform their
+    available actions with random targets
+
+    Returns the set of stages seen during the round
+    """
+    stages = set()
+    for user_id in driver.users:
+        state = driver.get_state(user_id)
+        stages.add(state.stage)
+
+        controls = state.controls_state
+        if not (controls.button_visible and controls.button_enabled):
+            continue
+
+        selected_id = None
+        if controls.button_submit_person:
+            targets = [
+                p.id
+                for p in state.players
+                if p.id != user_id and p.status == PlayerState.ALIVE
+            ]
+            if not targets:
+                continue
+            selected_id = driver.rng.choice(targets)
+
+        driver.act(user_id, controls.button_submit_func, selected_id)
+
+    return stages
+
+
+def simulate(driver_class, stats, num_games, num_players):
+    """
+    Play num_games interleaved games through lobby, night, day, voting and end
+    """
+    rng = random.Random(123)
+
+    drivers = [
+        driver_class(f"benchmark-game-{i}", num_players, stats, rng)
+        for i in range(num_games)
+    ]
+
+    finished = [False] * num_games
+
+    for _ in range(MAX_ROUNDS):
+        for i, driver in enumerate(drivers):
+            if finished[i]:
+                continue
+
+            if GameStage.ENDED in play_round(driver):
+                finished[i] = True
+
+        if all(finished):
+            break
+
+    logging.info("%s of %s games finished", sum(finished), num_games)
+    return sum(finished)
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def benchmark_db(request, db_session):
+    """
+    Point the backend at the database to benchmark, with a clean schema
+    """
+    import backend.database
+    from backend.model import Base
+
+    if request.param == "sqlite":
+        yield request.param, backend.database.engine
+        return
+
+    url = os.environ.get("BENCHMARK_POSTGRES_URL")
+    if not url:
+        pytest.skip("BENCHMARK_POSTGRES_URL not set")
+
+    old_url = os.environ["DATABASE_URL"]
+    os.environ["DATABASE_URL"] = url
+    try:
+        backend.database.load()
+        Base.metadata.drop_all(backend.database.engine)
+        Base.metadata.create_all(backend.database.engine)
+
+        yield request.param, backend.database.engine
+    finally:
+        os.environ["DATABASE_URL"] = old_url
+        backend.database.load()
+
+
+@pytest.fixture(scope="module")
+def benchmark_results(request):
+    """
+    Collect the results of all the benchmarks, then compare them to the
+    baseline or save them
+    """
+    results = {}
+    yield results
+
+    if request.config.getoption("--benchmark-save") and results:
+        baseline = _load_baseline()
+        baseline.update(results)
+        BASELINE_FILE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        logging.warning("Saved benchmark baseline to %s", BASELINE_FILE)
+
+
+def _load_baseline():
+    if BASELINE_FILE.exists():
+        return json.loads(BASELINE_FILE.read_text())
+    return {}
+
+
+def _check_against_baseline(scenario, summary):
+    baseline = _load_baseline().get(scenario)
+    if not baseline:
+        logging.warning("No baseline for %s", scenario)
+        return
+
+    regressions = []
+    for name, stats in summary.items():
+        if name not in baseline:
+            continue
+        for key in ["queries_per_request", "rows_per_request"]:
+            limit = baseline[name][key] * (1 + TOLERANCE)
+            if stats[key] > limit:
+                regressions.append(
+                    f"{name}: {key} = {stats[key]} (baseline {baseline[name][key]})"
+                )
+
+    assert not regressions, f"Regressions in {scenario}:\n" + "\n".join(regressions)
+
+
+@pytest.mark.parametrize("driver_class", [DirectDriver, APIDriver])
+def test_game_lifecycles(driver_class, benchmark_db, benchmark_results, request):
+    db_name, engine = benchmark_db
+    scenario = f"{driver_class.__name__}-{db_name}-{NUM_GAMES}x{NUM_PLAYERS}"
+
+    stats = RequestStats()
+
+    # Don't time the (very verbose) debug logging
+    logging.disable(logging.INFO)
+    try:
+        with stats.listening(engine):
+            num_finished = simulate(driver_class, stats, NUM_GAMES, NUM_PLAYERS)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    summary = stats.summary()
+    logging.warning(
+        "Benchmark %s:\n%s", scenario, json.dumps(summary, indent=2, sort_keys=True)
+    )
+
+    assert num_finished == NUM_GAMES
+
+    benchmark_results[scenario] = summary
+
+    if not request.config.getoption("--benchmark-save"):
+        _check_against_baseline(scenario, summary)
+
+
+# Renders of each player's state in the render micro-benchmark
+RENDER_REPEATS = 100
+
+
+def test_render_and_serialise(db_session):
+    """
+    Compare the time taken to build and serialise a FrontendState with and
+    without validation
+
+    The validated path reproduces the old behaviour: models validated on
+    construction, then encoded by FastAPI's jsonable_encoder.
+    """
+    from fastapi.encoders import jsonable_encoder
+
+    from backend.game import render_state
+    from backend.main import ModelResponse
+    from backend.model import FrontendState
+
+    rng = random.Random(123)
+    users = [UUID(int=rng.getrandbits(128)) for _ in range(NUM_PLAYERS)]
+    game = WurwolvesGame("benchmark-render")
+
+    logging.disable(logging.INFO)
+    try:
+        for u in users:
+            game.join(u)
+        game.start_game()
+        for i in range(50):
+            game.send_chat_message(f"Message {i}")
+
+        snapshot = game.get_snapshot()
+
+        def validated(user_id):
+            state = FrontendState.parse_obj(render_state(snapshot, user_id).dict())
+            return json.dumps(jsonable_encoder(state)).encode()
+
+        def trusted(user_id):
+            return ModelResponse(render_state(snapshot, user_id)).body
+
+        times = {}
+        for name, render in [("validated", validated), ("trusted", trusted)]:
+            t_start = time.perf_counter()
+            for _ in range(RENDER_REPEATS):
+                for u in users:
+                    render(u)
+            times[name] = (time.perf_counter() - t_start) / (
+                RENDER_REPEATS * len(users)
+            )
+    finally:
+        logging.disable(logging.NOTSET)
+
+    logging.warning(
+        "Render and serialise: validated %.0f us, trusted %.0f us per render (%.1fx faster)",
+        1e6 * times["validated"],
+        1e6 * times["trusted"],
+        times["validated"] / times["trusted"],
+    )
+
+    assert json.loads(validated(users[0])) == json.loads(trusted(users[0]))
+    assert times["trusted"] < times["validated"]
@@ -1,3 +1,4 @@
+from unittest.mock import patch
 from uuid import uuid4 as uuid
 
 import pytest
@@ -122,3 +123,136 @@ def test_parse_speed(demo_game_maker):
     time_per_render = out / (num_players * num_repeats)
 
     assert time_per_render < 0.2
+
+
+def test_snapshot_cached(demo_game):
+    from backend.game import snapshot_cache
+
+    snapshot = demo_game.get_snapshot()
+    assert snapshot_cache.get(demo_game.game_id) is snapshot
+
+    # Rendering doesn't reload the game if it hasn't changed
+    with patch.object(WurwolvesGame, "_load_snapshot") as mock_load:
+        WurwolvesGame(GAME_ID).parse_game_to_state(USER_ID)
+        mock_load.assert_not_called()
+
+
+def test_snapshot_invalidated(demo_game):
+    before = demo_game.parse_game_to_state(USER_ID)
+
+    demo_game.send_chat_message("Hello snapshot")
+
+    after = demo_game.parse_game_to_state(USER_ID)
+
+    assert before.state_hash != after.state_hash
+    assert any(m.msg == "Hello snapshot" for m in after.chat)
+
+
+def test_snapshot_stale_tag(demo_game, db_session):
+    from backend.game import snapshot_cache
+    from backend.model import Game
+
+    demo_game.parse_game_to_state(USER_ID)
+
+    # Change the game behind the cache's back, e.g. from another worker
+    game = db_session.query(Game).get(demo_game.game_id)
+    game.touch()
+    db_session.commit()
+
+    assert (
+        snapshot_cache.get(demo_game.game_id).game.update_tag
+        != demo_game.get_hash_now()
+    )
+    assert demo_game.parse_game_to_state(USER_ID).state_hash == demo_game.get_hash_now()
+
+
+def test_actions_computed_once_per_snapshot(demo_game_maker):
+    num_players = 6
+    demo_game = demo_game_maker(num_players)
+    demo_game.start_game()
+
+    users = [p.user_id for p in demo_game.get_game_model().players]
+
+    with patch.object(
+        WurwolvesGame,
+        "player_has_action",
+        autospec=True,
+        side_effect=WurwolvesGame.player_has_action,
+    ) as mock_has_action:
+        for u in users:
+            WurwolvesGame(GAME_ID).parse_game_to_state(u)
+
+    assert mock_has_action.call_count == num_players
+
+
+def test_render_message_visibility(demo_game):
+    from backend.game import render_state
+
+    other_user = [
+        p.user_id for p in demo_game.get_game_model().players if p.user_id != USER_ID
+    ][0]
+
+    demo_game.send_chat_message("Secret", user_list=[USER_ID])
+    demo_game.send_chat_message("Public")
+
+    snapshot = demo_game.get_snapshot()
+
+    chat = [m.msg for m in render_state(snapshot, USER_ID).chat]
+    other_chat = [m.msg for m in render_state(snapshot, other_user).chat]
+
+    assert "Secret" in chat and "Public" in chat
+    assert "Secret" not in other_chat and "Public" in other_chat
+
+
+def test_render_chat_since(demo_game):
+    from backend.game import render_state
+
+    demo_game.clear_chat_messages()
+    demo_game.send_chat_message("Old")
+
+    snapshot = demo_game.get_snapshot()
+    state = render_state(snapshot, USER_ID)
+    assert [m.msg for m in state.chat] == ["Old"]
+    assert state.chatSince is None
+    assert state.chatStart == state.chatCursor == state.chat[0].id
+
+    demo_game.send_chat_message("New")
+
+    update = render_state(
+        demo_game.get_snapshot(), USER_ID, chat_since=state.chatCursor
+    )
+    assert [m.msg for m in update.chat] == ["New"]
+    assert update.chatSince == state.chatCursor
+    assert update.chatStart == state.chatStart
+    assert update.chatCursor > state.chatCursor
+
+    # Clients should drop all their messages once the chat is cleared
+    demo_game.clear_chat_messages()
+    cleared = render_state(
+        demo_game.get_snapshot(), USER_ID, chat_since=update.chatCursor
+    )
+    assert cleared.chat == []
+    assert cleared.chatStart > update.chatCursor
+
+
+def test_render_matches_validated(db_session):
+    """
+    render_state builds its models without validation: check they're the same
+    as if they were validated
+    """
+    from backend.game import render_state
+    from backend.model import FrontendState
+
+    game = WurwolvesGame(GAME_ID)
+    for _ in range(5):
+        game.join(uuid())
+    game.start_game()
+
+    snapshot = game.get_snapshot()
+
+    for p in snapshot.players:
+        state = render_state(snapshot, p.user_id)
+        validated = FrontendState.parse_obj(state.dict())
+
+        assert state.dict() == validated.dict()
+        assert state.json() == validated.json()
@@ -3,7 +3,10 @@ from unittest.mock import patch
 from uuid import uuid4 as uuid
 
 import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
 
+from backend import presence
 from backend.game import WurwolvesGame
 from backend.model import Game
 from backend.model import GameStage
@@ -182,6 +185,28 @@ def test_chat(demo_game_factory, db_session):
     assert "This one is in a different game" not in summary
 
 
+def test_chat_recipients(demo_game, db_session):
+    other_user = uuid()
+    demo_game.join(other_user)
+    player_id = demo_game.get_player_id(USER_ID)
+    other_player_id = demo_game.get_player_id(other_user)
+
+    demo_game.send_chat_message("Public")
+    demo_game.send_chat_message(
+        "Both", user_list=[USER_ID], player_list=[other_player_id, player_id]
+    )
+
+    db_session.expire_all()
+
+    public, both = demo_game.get_game().messages[-2:]
+
+    assert public.recipients is None
+    assert both.recipients == sorted([player_id, other_player_id])
+
+    texts = [m.text for m in demo_game.get_messages(other_user)]
+    assert texts[-2:] == ["Public", "Both"]
+
+
 def test_chat_order(demo_game):
     # Clear current messages
     demo_game.clear_chat_messages()
@@ -225,7 +250,7 @@ def test_chat_order_deletions(demo_game):
     game = demo_game.get_game()
     db_session.add(game)
 
-    game.messages[1].expired = True
+    next(m for m in game.messages if m.text == "To be deleted").expired = True
     db_session.commit()
     db_session.expire_all()
 
@@ -342,6 +367,30 @@ def test_async_get_start_game(db_session, demo_game):
     asyncio.get_event_loop().run_until_complete(tester())
 
 
+def test_async_get_hash_change_while_reading(db_session, demo_game):
+    import asyncio
+
+    initial_hash = demo_game.get_hash_now()
+    read_hash = demo_game._read_hash_async
+
+    async def read_then_change():
+        # The game changes after its hash was read but before it was compared
+        current_hash = await read_hash()
+        demo_game.send_chat_message("Hello world")
+        return current_hash
+
+    async def tester():
+        with patch.object(demo_game, "_read_hash_async", side_effect=read_then_change):
+            task_waiter = asyncio.ensure_future(
+                demo_game.get_hash(known_hash=initial_hash, timeout=1)
+            )
+            await asyncio.sleep(0.1)
+
+        assert task_waiter.done()
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+
 def test_kick(db_session):
     game = WurwolvesGame(GAME_ID)
 
@@ -371,8 +420,9 @@ def test_kick(db_session):
 
     assert timeout_player.state == PlayerState.SPECTATING
 
-    # Keepalive one of the other players, which should kick the idler
+    # Keepalive one of the other players, then sweep, which should kick the idler
     game.player_keepalive(player_ids[1])
+    presence.sweep()
 
     db_session.expire_all()
 
@@ -436,6 +486,7 @@ def test_kick_with_actions(db_session):
 
     # Keepalive one of the other players, which should not kick the idler since it's a game
     game.player_keepalive(wolf_id)
+    presence.sweep()
 
     db_session.expire_all()
     assert game.get_player(timeout_player_id)
@@ -452,6 +503,7 @@ def test_kick_with_actions(db_session):
 
     # Keepalive someone else
     game.player_keepalive(wolf_id)
+    presence.sweep()
 
     # Player should not yet be kicked
     db_session.expire_all()
@@ -465,6 +517,7 @@ def test_kick_with_actions(db_session):
 
     # Keepalive someone else
     game.player_keepalive(wolf_id)
+    presence.sweep()
 
     # They still should be visible, but marked as inactive now
     db_session.expire_all()
@@ -480,6 +533,7 @@ def test_kick_with_actions(db_session):
 
     # Check the idler was kicked after the next keepalive
     game.player_keepalive(wolf_id)
+    presence.sweep()
     assert not game.get_player(timeout_player_id)
 
 
@@ -523,6 +577,7 @@ def test_not_kicked_during_game(db_session):
 
     # Keepalive one of the other players, which should not kick the idler since it's a game
     game.player_keepalive(wolf_id)
+    presence.sweep()
 
     db_session.expire_all()
     assert game.get_player(timeout_player_id)
@@ -576,3 +631,163 @@ def test_killed_twice(db_session):
 #         )
 #         == num_prev_stages - 1
 #     )
+
+
+def test_actions_model_is_slim(demo_game):
+    from backend.model import SlimActionModel
+
+    demo_game.start_game()
+    demo_game.set_player_role(demo_game.get_player_id(USER_ID), PlayerRole.MEDIC)
+    demo_game.medic_night_action(USER_ID, USER_ID)
+
+    actions = demo_game.get_actions_model()
+
+    assert len(actions) == 1
+    assert type(actions[0]) is SlimActionModel
+    assert actions[0].player_id == demo_game.get_player_id(USER_ID)
+    assert actions[0].stage == GameStage.NIGHT
+
+
+def test_get_actions_filters_in_database(demo_game, db_session):
+    from backend.model import Action
+
+    demo_game.start_game()
+    player_id = demo_game.get_player_id(USER_ID)
+    game_id = demo_game.game_id
+
+    def add_action(stage_id, expired):
+        db_session.add(
+            Action(
+                game_id=game_id,
+                player_id=player_id,
+                stage_id=stage_id,
+                stage=GameStage.NIGHT,
+                role=PlayerRole.VILLAGER,
+                expired=expired,
+            )
+        )
+
+    for stage_id in range(1, 11):
+        add_action(stage_id, expired=True)
+    add_action(11, expired=False)
+    add_action(12, expired=False)
+    db_session.commit()
+
+    # Filtered by the query, not by loading the game's actions
+    with patch.object(demo_game, "get_game", side_effect=AssertionError):
+        actions = demo_game.get_actions(stage_id=11)
+
+    assert [a.stage_id for a in actions] == [11]
+
+    assert len(demo_game.get_actions()) == 2
+    assert len(demo_game.get_actions(include_expired=True)) == 12
+    assert len(demo_game.get_actions(player_id=player_id, stage=GameStage.DAY)) == 0
+
+    demo_game.clear_actions()
+    assert demo_game.get_actions() == []
+
+
+def test_get_players_filters_in_database(demo_game):
+    demo_game.start_game()
+    player_id = demo_game.get_player_id(USER_ID)
+    demo_game.set_player_role(player_id, PlayerRole.MEDIC)
+
+    with patch.object(demo_game, "get_game", side_effect=AssertionError):
+        assert [p.id for p in demo_game.get_players(PlayerRole.MEDIC)] == [player_id]
+        assert demo_game.get_player(USER_ID).id == player_id
+        assert demo_game.get_player(uuid()) is None
+
+    with pytest.raises(KeyError):
+        demo_game.get_player_id(uuid())
+
+    with pytest.raises(HTTPException):
+        WurwolvesGame("not-a-game").get_players()
+
+
+def test_lookup_indexes(engine):
+    from sqlalchemy import inspect
+
+    inspector = inspect(engine)
+
+    def index_columns(table):
+        return [tuple(i["column_names"]) for i in inspector.get_indexes(table)]
+
+    assert ("game_id", "stage_id", "expired") in index_columns("actions")
+    assert ("game_id", "user_id") in index_columns("players")
+    assert ("game_id", "expired", "id") in index_columns("messages")
+
+
+def _count_queries(engine, func):
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        func()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    return statements
+
+
+@pytest.mark.parametrize("num_players", [3, 8])
+def test_loader_profiles_query_count(db_session, engine, num_players):
+    game = WurwolvesGame(GAME_ID)
+    user_ids = [uuid() for _ in range(num_players)]
+    for user_id in user_ids:
+        game.join(user_id)
+    game.start_game()
+    for i in range(5):
+        game.send_chat_message(f"Message {i}")
+
+    stage = game.get_game_model()
+    presence.store.clear()
+
+    # Game with players, messages, actions, then the previous nights
+    assert len(_count_queries(engine, game._load_snapshot)) == 4
+
+    # Active players, game with players, actions
+    assert (
+        len(
+            _count_queries(
+                engine, lambda: game.process_actions(stage.stage, stage.stage_id)
+            )
+        )
+        == 3
+    )
+
+    # Player, their last_seen, game with players
+    assert len(_count_queries(engine, lambda: game.player_keepalive(user_ids[0]))) == 3
+
+
+def test_read_hash_without_session(demo_game, engine):
+    expected = demo_game.get_hash_now()
+
+    with patch("backend.database.Session", side_effect=AssertionError):
+        assert demo_game.read_hash() == expected
+
+    assert WurwolvesGame("not-a-game").read_hash() == 0
+
+
+def test_read_hash_cached(demo_game, engine):
+    import asyncio
+
+    from backend import notifications
+
+    notifier = notifications.get_notifier()
+
+    with patch.object(notifier, "can_cache_hashes", return_value=True):
+        initial_hash = demo_game.read_hash()
+
+        assert _count_queries(engine, demo_game.read_hash) == []
+        assert (
+            asyncio.get_event_loop().run_until_complete(demo_game.get_hash())
+            == initial_hash
+        )
+
+        # Changes are picked up straight away
+        demo_game.send_chat_message("Hello")
+        assert demo_game.read_hash() != initial_hash
+        assert demo_game.read_hash() == demo_game.get_hash_now()
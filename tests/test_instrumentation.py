@@ -0,0 +1,88 @@
+import re
+
+from backend import instrumentation
+from backend.game import WurwolvesGame
+
+GAME_ID = "hot-potato"
+
+
+def _prometheus_value(text, name, route, method="GET"):
+    match = re.search(
+        rf'^{name}{{method="{method}",route="{re.escape(route)}"}} (\S+)$',
+        text,
+        re.MULTILINE,
+    )
+    assert match, f"{name} not found for {route}"
+    return float(match.group(1))
+
+
+def test_server_timing_header(api_client):
+    api_client.post(f"/api/{GAME_ID}/join")
+
+    r = api_client.get(f"/api/{GAME_ID}/state")
+    assert r.status_code == 200
+
+    timing = r.headers["Server-Timing"]
+    assert "db;dur=" in timing
+    assert "session;dur=" in timing
+    assert "total;dur=" in timing
+
+    num_queries = int(re.search(r"(\d+) queries", timing).group(1))
+    assert num_queries > 0
+
+
+def test_no_queries_for_static_route(api_client):
+    r = api_client.get("/api/hello")
+    assert '"0 queries, 0 rows"' in r.headers["Server-Timing"]
+
+
+def test_metrics_by_route(api_client):
+    instrumentation.reset()
+
+    api_client.post(f"/api/{GAME_ID}/join")
+    for _ in range(3):
+        api_client.get(f"/api/{GAME_ID}/state")
+    api_client.get("/api/hello")
+
+    r = api_client.get("/api/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+
+    text = r.text
+    state_route = "/api/{game_tag}/state"
+
+    assert _prometheus_value(text, "wurwolves_requests_total", state_route) == 3
+    assert _prometheus_value(text, "wurwolves_db_queries_total", state_route) > 0
+    assert _prometheus_value(text, "wurwolves_db_rows_total", state_route) > 0
+    assert (
+        _prometheus_value(
+            text, "wurwolves_requests_total", "/api/{game_tag}/join", method="POST"
+        )
+        == 1
+    )
+    assert _prometheus_value(text, "wurwolves_db_queries_total", "/api/hello") == 0
+
+
+def test_metrics_action_route(api_client):
+    instrumentation.reset()
+
+    api_client.post(f"/api/{GAME_ID}/join")
+    api_client.post(f"/api/{GAME_ID}/spectator_lobby_action")
+
+    text = instrumentation.render_prometheus()
+    assert (
+        _prometheus_value(
+            text,
+            "wurwolves_requests_total",
+            "/api/{game_tag}/spectator_lobby_action",
+            method="POST",
+        )
+        == 1
+    )
+
+
+def test_no_metrics_outside_requests(db_session):
+    assert instrumentation.current_metrics() is None
+
+    # Database access outside a request is not an error
+    WurwolvesGame(GAME_ID).get_hash_now()
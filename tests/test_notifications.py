@@ -0,0 +1,141 @@
+import asyncio
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from backend import notifications
+from backend.notifications import LocalNotificationBackend
+from backend.notifications import PostgresNotificationBackend
+
+GAME_ID = 123
+
+
+def test_local_wait_timeout():
+    notifier = LocalNotificationBackend()
+
+    async def tester():
+        assert not await notifier.wait(GAME_ID, timeout=0.1)
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+    # Waiters are cleaned up once they're done
+    assert not notifier._waiters
+
+
+def test_local_notify():
+    notifier = LocalNotificationBackend()
+
+    async def tester():
+        waiters = [
+            asyncio.ensure_future(notifier.wait(GAME_ID, timeout=1)) for _ in range(3)
+        ]
+        other_game = asyncio.ensure_future(notifier.wait(GAME_ID + 1, timeout=0.3))
+
+        await asyncio.sleep(0.1)
+        assert not any(w.done() for w in waiters)
+
+        notifier.notify(GAME_ID)
+
+        await asyncio.sleep(0.1)
+        assert all(w.done() and w.result() for w in waiters)
+        assert not other_game.done()
+        assert not await other_game
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+
+def test_local_subscribe_before_waiting():
+    notifier = LocalNotificationBackend()
+
+    async def tester():
+        with notifier.subscribe(GAME_ID) as changed:
+            notifier.notify(GAME_ID)
+            assert await notifications.wait_for_event(changed, timeout=0.1)
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+    assert not notifier._waiters
+
+
+def test_local_notify_from_thread():
+    """
+    Sync routes run in a threadpool, so notifications can arrive from any thread
+    """
+    notifier = LocalNotificationBackend()
+
+    async def tester():
+        waiter = asyncio.ensure_future(notifier.wait(GAME_ID, timeout=1))
+        await asyncio.sleep(0.1)
+
+        t = threading.Thread(target=notifier.notify, args=(GAME_ID,))
+        t.start()
+        t.join()
+
+        assert await waiter
+
+    asyncio.get_event_loop().run_until_complete(tester())
+
+
+def test_default_backend_for_sqlite(engine):
+    assert isinstance(notifications.get_notifier(), LocalNotificationBackend)
+
+
+def test_backend_from_env(monkeypatch):
+    engine = Mock()
+    engine.dialect.name = "sqlite"
+
+    monkeypatch.setenv("NOTIFICATION_BACKEND", "postgres")
+    assert isinstance(notifications.make_notifier(engine), PostgresNotificationBackend)
+
+    monkeypatch.setenv("NOTIFICATION_BACKEND", "nonsense")
+    with pytest.raises(ValueError):
+        notifications.make_notifier(engine)
+
+
+def test_postgres_ignores_own_notifications():
+    notifier = PostgresNotificationBackend(Mock())
+    notifier._wake_local = Mock()
+
+    notifier._handle_payload(f"{notifier._token}:{GAME_ID}")
+    notifier._wake_local.assert_not_called()
+
+    notifier._handle_payload(f"someoneelse:{GAME_ID}")
+    notifier._wake_local.assert_called_once_with(GAME_ID)
+
+    notifier._handle_payload("garbage")
+    notifier._wake_local.assert_called_once()
+
+
+def test_hash_cache():
+    notifier = LocalNotificationBackend()
+    notifier.can_cache_hashes = lambda: True
+
+    token = notifier.hash_token()
+    notifier.cache_hash(GAME_ID, 1, token)
+    assert notifier.get_cached_hash(GAME_ID) == 1
+
+    notifier.notify(GAME_ID)
+    assert notifier.get_cached_hash(GAME_ID) is None
+
+    # A hash read before a notification isn't cached after it
+    token = notifier.hash_token()
+    notifier.notify(GAME_ID + 1)
+    notifier.cache_hash(GAME_ID, 1, token)
+    assert notifier.get_cached_hash(GAME_ID) is None
+
+
+def test_hash_cache_needs_broadcasts():
+    notifier = LocalNotificationBackend()
+    notifier.cache_hash(GAME_ID, 1, notifier.hash_token())
+    assert notifier.get_cached_hash(GAME_ID) is None
+
+    # The Postgres backend only caches while it's listening
+    notifier = PostgresNotificationBackend(Mock())
+    assert not notifier.can_cache_hashes()
+    notifier._listening = True
+    notifier.cache_hash(GAME_ID, 1, notifier.hash_token())
+    assert notifier.get_cached_hash(GAME_ID) == 1
+
+    notifier._handle_payload(f"someoneelse:{GAME_ID}")
+    assert notifier.get_cached_hash(GAME_ID) is None
@@ -954,3 +954,31 @@ def test_exorcist_fail(five_player_game):
     assert game.get_player_model(roles_map["Wolf"]).state == PlayerState.ALIVE
     assert game.get_player_model(exorcist_id).state == PlayerState.WOLFED
     assert re.search(r"You chose.+poorly", get_summary_of_chat(game, exorcist_id))
+
+
+def test_team_tally(five_player_game):
+    from backend.roles import Team
+    from backend.roles import TeamTally
+    from backend.roles import team_has_won
+
+    game, _ = five_player_game
+
+    with patch.object(
+        game,
+        "get_players_model",
+        side_effect=AssertionError("Players shouldn't be converted"),
+    ):
+        tally = TeamTally.from_game(game)
+
+    assert tally.number_of(Team.WOLVES, PlayerState.ALIVE) == 1
+    assert tally.number_of(Team.VILLAGERS, PlayerState.ALIVE) == 4
+    assert tally.number_of(Team.JESTER, PlayerState.LYNCHED) == 0
+    assert not any(team_has_won(tally, team) for team in list(Team))
+
+    wolf = game.get_players(role=PlayerRole.WOLF)[0]
+    game.kill_player(wolf.id, PlayerState.LYNCHED)
+
+    tally = TeamTally.from_game(game)
+    assert [team for team in list(Team) if team_has_won(tally, team)] == [
+        Team.VILLAGERS
+    ]
@@ -0,0 +1,226 @@
+import asyncio
+import datetime
+from unittest.mock import patch
+from uuid import uuid4 as uuid
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from backend import presence
+from backend.game import WurwolvesGame
+from backend.model import Player
+
+GAME_ID = "hot-potato"
+
+
+@pytest.fixture
+def game(db_session):
+    g = WurwolvesGame(GAME_ID)
+    g.join(uuid())
+    return g
+
+
+def _get_last_seen(db_session, player_id):
+    db_session.expire_all()
+    return db_session.query(Player).get(player_id).last_seen
+
+
+def test_keepalive_without_database(game, engine):
+    user_id = uuid()
+    game.join(user_id)
+
+    queries = []
+
+    def count(*args, **kwargs):
+        queries.append(args)
+
+    event.listen(engine, "after_cursor_execute", count)
+    try:
+        for _ in range(5):
+            game.player_keepalive(user_id)
+    finally:
+        event.remove(engine, "after_cursor_execute", count)
+
+    assert not queries
+
+
+def test_keepalive_unknown_player(game):
+    with pytest.raises(HTTPException) as e:
+        game.player_keepalive(uuid())
+
+    assert e.value.status_code == 404
+
+
+def test_keepalive_reverifies(game, db_session):
+    user_id = uuid()
+    game.join(user_id)
+    player_id = game.get_player_id(user_id)
+
+    db_session.query(Player).filter(Player.id == player_id).delete()
+    db_session.commit()
+
+    # Still trusted
+    game.player_keepalive(user_id)
+
+    with patch("backend.presence.PRESENCE_VERIFY_INTERVAL", -1):
+        with pytest.raises(HTTPException):
+            game.player_keepalive(user_id)
+
+
+def test_sweep_flushes_heartbeats(game, db_session):
+    user_id = uuid()
+    game.join(user_id)
+    player_id = game.get_player_id(user_id)
+    joined = _get_last_seen(db_session, player_id)
+
+    game.player_keepalive(user_id)
+    heartbeat = presence.store.get_heartbeats(game.game_id)[player_id]
+
+    presence.sweep()
+    assert _get_last_seen(db_session, player_id) == heartbeat > joined
+
+    # Heartbeats which have already been written aren't written again
+    assert presence.store.collect() == []
+
+
+def test_flush_only_moves_forwards(game, db_session):
+    player_id = game.get_players()[0].id
+    latest = _get_last_seen(db_session, player_id)
+
+    presence.flush_last_seen([(player_id, datetime.datetime(2000, 1, 1))])
+
+    assert _get_last_seen(db_session, player_id) == latest
+
+
+def test_sweep_without_changes(game):
+    user_id = uuid()
+    game.join(user_id)
+    tag = game.get_game_model().update_tag
+
+    with patch("backend.game.trigger_update_event") as trigger:
+        game.player_keepalive(user_id)
+        presence.sweep()
+
+    assert game.get_game_model().update_tag == tag
+    trigger.assert_not_called()
+
+
+def _set_last_seen(db_session, game, user_id, last_seen):
+    db_session.query(Player).filter(Player.id == game.get_player_id(user_id)).update(
+        {"last_seen": last_seen}
+    )
+    db_session.commit()
+
+
+def test_sweep_activity(db_session, engine):
+    games = [WurwolvesGame(f"{GAME_ID}-{i}") for i in range(3)]
+    user_ids = [[uuid(), uuid()] for _ in games]
+    for g, users in zip(games, user_ids):
+        for u in users:
+            g.join(u)
+
+    long_ago = datetime.datetime(2000, 1, 1)
+
+    # Game 0 has an idler, game 1 is quiet and everyone in game 2 has left
+    _set_last_seen(db_session, games[0], user_ids[0][0], long_ago)
+    for u in user_ids[2]:
+        _set_last_seen(db_session, games[2], u, long_ago)
+
+    updates = []
+
+    def count_updates(conn, cursor, statement, *args):
+        if statement.startswith("UPDATE"):
+            updates.append(statement)
+
+    event.listen(engine, "after_cursor_execute", count_updates)
+    try:
+        flipped = presence.sweep_activity()
+    finally:
+        event.remove(engine, "after_cursor_execute", count_updates)
+
+    assert flipped == {games[0].game_id}
+    assert len(updates) == 1
+
+    db_session.expire_all()
+    assert not games[0].get_player(user_ids[0][0], filter_by_activity=False).active
+    assert games[0].get_player(user_ids[0][1], filter_by_activity=False).active
+    assert games[2].get_player(user_ids[2][0], filter_by_activity=False).active
+
+    # Once they're back, they're marked as active again
+    _set_last_seen(db_session, games[0], user_ids[0][0], datetime.datetime.utcnow())
+    assert presence.sweep_activity() == {games[0].game_id}
+    assert presence.sweep_activity() == set()
+
+
+def test_stale_threshold_covers_flush_lag(game, db_session):
+    user_id = uuid()
+    game.join(user_id)
+
+    # Seen by another worker, which hasn't flushed their latest heartbeat yet
+    lag = datetime.timedelta(seconds=50)
+    _set_last_seen(db_session, game, user_id, datetime.datetime.utcnow() - lag)
+
+    with patch("backend.presence.PRESENCE_SWEEP_INTERVAL", 45):
+        assert presence.max_last_seen_lag() > lag
+        assert presence.sweep_activity() == set()
+
+    assert presence.sweep_activity() == {game.game_id}
+
+
+def test_sweep_touches_changed_games(db_session):
+    game = WurwolvesGame(GAME_ID)
+    other_game = WurwolvesGame(f"{GAME_ID}-other")
+    user_ids = [uuid(), uuid()]
+    for u in user_ids:
+        game.join(u)
+        other_game.join(u)
+
+    _set_last_seen(db_session, game, user_ids[0], datetime.datetime(2000, 1, 1))
+
+    tag = game.get_game_model().update_tag
+    other_tag = other_game.get_game_model().update_tag
+
+    presence.sweep()
+
+    assert game.get_game_model().update_tag != tag
+    assert other_game.get_game_model().update_tag == other_tag
+
+
+def test_sweep_lock(game, db_session):
+    user_id = uuid()
+    game.join(user_id)
+    _set_last_seen(db_session, game, user_id, datetime.datetime(2000, 1, 1))
+
+    # Another sweep is in progress
+    with presence._sweep_lock:
+        assert presence.sweep_activity() == set()
+
+    assert presence.sweep_activity() == {game.game_id}
+
+
+def test_update_activity_uses_heartbeats(game, db_session):
+    user_id = uuid()
+    game.join(user_id)
+    game.player_keepalive(user_id)
+
+    # This worker has heard from them since last_seen was written
+    _set_last_seen(db_session, game, user_id, datetime.datetime(2000, 1, 1))
+
+    with patch("backend.game.trigger_update_event") as trigger:
+        game.update_activity()
+
+    assert game.get_player(user_id, filter_by_activity=False).active
+    trigger.assert_not_called()
+
+
+def test_run_sweeper(db_session):
+    async def tester():
+        with patch("backend.presence.sweep") as sweep:
+            task = asyncio.ensure_future(presence.run_sweeper(interval=0.05))
+            await asyncio.sleep(0.2)
+            task.cancel()
+
+        assert sweep.call_count >= 2
+
+    asyncio.get_event_loop().run_until_complete(tester())
@@ -0,0 +1,72 @@
+from uuid import uuid4 as uuid
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT
+
+from backend import queries
+from backend.game import WurwolvesGame
+
+GAME_ID = "hot-potato"
+
+
+@pytest.fixture
+def game(db_session) -> WurwolvesGame:
+    g = WurwolvesGame(GAME_ID)
+    g.join(uuid())
+    return g
+
+
+def _cache_hits(engine, func):
+    hits = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        hits.append(context.cache_hit == CACHE_HIT)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        func()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    return hits
+
+
+def test_lookups_use_compiled_cache(game, db_session, engine):
+    user_id = game.get_players()[0].user_id
+    other_game = WurwolvesGame(f"{GAME_ID}-other")
+    other_game.join(user_id)
+
+    def lookups(g):
+        def func():
+            queries.get_game(db_session, g.game_id, "render")
+            queries.get_hash(db_session, g.game_id)
+            queries.get_player(db_session, g.game_id, user_id, active_only=True)
+            queries.get_player_id(db_session, g.game_id, user_id)
+            queries.get_stage_actions(db_session, g.game_id, 1)
+
+        return func
+
+    _cache_hits(engine, lookups(game))
+    db_session.expire_all()
+
+    # The same statements with different parameters are already compiled
+    hits = _cache_hits(engine, lookups(other_game))
+    assert hits and all(hits)
+
+
+def test_lookups(game, db_session):
+    player = game.get_players()[0]
+
+    assert queries.get_game(db_session, game.game_id).id == game.game_id
+    assert queries.get_game(db_session, -1) is None
+    assert queries.get_hash(db_session, game.game_id) == game.get_game().update_tag
+    assert queries.get_hash(db_session, -1) is None
+
+    assert queries.get_player(db_session, game.game_id, player.user_id).id == player.id
+    assert queries.get_player(db_session, game.game_id, uuid()) is None
+    assert queries.get_player_id(db_session, game.game_id, player.user_id) == player.id
+    assert queries.get_player_by_id(db_session, player.id).user_id == player.user_id
+    assert queries.get_user(db_session, player.user_id).id == player.user_id
+
+    assert queries.get_stage_actions(db_session, game.game_id, 1) == []
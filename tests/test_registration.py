@@ -0,0 +1,65 @@
+import pydantic
+import pytest
+
+from backend.model import GameStage
+from backend.model import PlayerRole
+from backend.roles import registration
+from backend.roles import Team
+
+
+@pytest.mark.parametrize("role", list(PlayerRole))
+def test_lookup_tables_match_role_map(role):
+    desc = registration._resolve_role_description(role)
+
+    assert registration.get_role_description(role) is desc
+    assert registration.get_role_team(role) == desc.team
+    assert role in registration.get_team_roles(desc.team)
+
+    for stage in GameStage:
+        assert registration.get_role_action(
+            role, stage
+        ) is registration._resolve_role_action(role, stage)
+
+        apparant_role, apparant_desc = registration.get_apparant_role(role, stage)
+        expected_role = desc.masked_role_in_stages.get(stage, role)
+        assert apparant_role == expected_role
+        assert apparant_desc is registration._resolve_role_description(expected_role)
+
+
+def test_team_roles():
+    all_roles = [r for team in Team for r in registration.get_team_roles(team)]
+
+    assert sorted(all_roles) == sorted(PlayerRole)
+    assert registration.get_team_roles(Team.WOLVES) == {PlayerRole.WOLF}
+
+
+def test_lookup_tables_are_immutable():
+    with pytest.raises(TypeError):
+        registration.ROLE_TEAMS[PlayerRole.WOLF] = Team.VILLAGERS
+
+
+def test_stage_actions_are_shared():
+    desc = registration.get_role_description(PlayerRole.WOLF)
+
+    action = desc.get_stage_action(GameStage.DAY)
+
+    assert action is desc.get_stage_action(GameStage.DAY)
+    with pytest.raises(pydantic.ValidationError):
+        action.button_text = "Something else"
+
+
+def test_stage_action_fallback():
+    wolf = registration.get_role_description(PlayerRole.WOLF)
+    villager = registration.get_role_description(PlayerRole.VILLAGER)
+
+    # The wolf's day text is its own, but the button comes from the villager
+    day_action = wolf.get_stage_action(GameStage.DAY)
+    assert day_action.text == wolf.stages[GameStage.DAY].text
+    assert day_action.button_text == "Move to vote"
+    assert not wolf.stages[GameStage.DAY].button_text
+
+    # Stages the wolf doesn't define are taken directly from the villager
+    assert GameStage.VOTING not in wolf.stages
+    assert wolf.get_stage_action(GameStage.VOTING) is villager.get_stage_action(
+        GameStage.VOTING
+    )
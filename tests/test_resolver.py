@@ -159,6 +159,7 @@ def test_actions_framework(m1, m2, m3, wolf_medic_game_model):
     mock_game = Mock()
     mock_game.get_game_model.return_value = mock_game_model
     mock_game.get_players_model.return_value = wolf_medic_game_model["players"]
+    mock_game.get_players.return_value = wolf_medic_game_model["players"]
     mock_game.get_actions_model.return_value = wolf_medic_game_model["actions"]
 
     process_actions(mock_game, mock_game_model.stage, mock_game_model.stage_id)
@@ -178,6 +179,7 @@ def test_actions_chat(wolf_medic_seer_game_model):
     mock_game = Mock()
     mock_game.get_game_model.return_value = mock_game_model
     mock_game.get_players_model.return_value = wolf_medic_seer_game_model["players"]
+    mock_game.get_players.return_value = wolf_medic_seer_game_model["players"]
     mock_game.get_actions_model.return_value = wolf_medic_seer_game_model["actions"]
 
     process_actions(mock_game, mock_game_model.stage, mock_game_model.stage_id)
@@ -0,0 +1,91 @@
+import copy
+import time
+
+import pytest
+
+from backend.utils import apply_json_patch
+from backend.utils import LRUCache
+from backend.utils import make_json_patch
+
+
+def test_lru_cache_get_put():
+    cache = LRUCache(max_size=2, ttl=60)
+
+    assert cache.get("a") is None
+    assert cache.get("a", 123) == 123
+
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert len(cache) == 1
+
+
+def test_lru_cache_evicts_least_recent():
+    cache = LRUCache(max_size=2, ttl=60)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    # Using "a" makes "b" the least recently used
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_expires():
+    cache = LRUCache(max_size=2, ttl=0.05)
+
+    cache.put("a", 1)
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_pop_and_clear():
+    cache = LRUCache(max_size=2, ttl=60)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    cache.pop("a")
+    cache.pop("not present")
+    assert cache.get("a") is None
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [
+        ({"a": 1, "b": [1, 2]}, {"a": 1, "b": [1, 2]}),
+        ({"a": 1, "b": "x"}, {"a": 2, "c": "x"}),
+        ({"a": [1, 2, 3]}, {"a": [1, 5]}),
+        ({"a": [{"x": 1}]}, {"a": [{"x": 2}, {"y": 3}]}),
+        ({"a/b": {"~c": True}}, {"a/b": {"~c": False}}),
+        ({"a": None}, {"a": {"b": []}}),
+        ([1, 2], {"a": 1}),
+    ],
+)
+def test_json_patch(old, new):
+    patch = make_json_patch(old, new)
+
+    assert apply_json_patch(copy.deepcopy(old), patch) == new
+    if old == new:
+        assert patch == []
+
+
+def test_json_patch_is_small():
+    old = {"players": [{"id": i, "ready": False} for i in range(10)], "chat": ["a"]}
+    new = copy.deepcopy(old)
+    new["players"][3]["ready"] = True
+    new["chat"].append("b")
+
+    assert make_json_patch(old, new) == [
+        {"op": "replace", "path": "/players/3/ready", "value": True},
+        {"op": "add", "path": "/chat/-", "value": "b"},
+    ]